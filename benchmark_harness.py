@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the time generate_data.py and generate_graphs.py spend on their own
+# orchestration, as opposed to running codecs and metrics tools. Synthetic clips
+# are run through the real job pipeline with trivial stand-ins for the encoder,
+# decoder and tiny_ssim binaries, so no codec builds are needed.
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_data
+import results_io
+
+# Stand-in encoder: INPUT WIDTH HEIGHT FPS BITRATE_KBPS [OUTPUT DIVIDE]...
+# Reads the whole input and writes an .ivf file per temporal layer, with
+# payloads sized to match the target bitrate.
+STAND_IN_ENCODER = r'''
+import struct
+import sys
+(input_file, width, height, fps, bitrate_kbps) = sys.argv[1:6]
+(width, height, fps, bitrate_kbps) = (int(width), int(height), float(fps), int(bitrate_kbps))
+frame_size = width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+num_frames = 0
+with open(input_file, 'rb') as f:
+  while len(f.read(frame_size)) == frame_size:
+    num_frames += 1
+layers = sys.argv[6:]
+for i in range(0, len(layers), 2):
+  divide = int(layers[i + 1])
+  payload_size = max(1, int(bitrate_kbps * 1000 / 8 / fps))
+  frames = range(0, num_frames, divide)
+  with open(layers[i], 'wb') as f:
+    f.write(b'DKIF' + struct.pack('<HHIHHIIII', 0, 32, 0x30385056, width, height, int(fps), 1, len(frames), 0))
+    for frame in frames:
+      f.write(struct.pack('<IQ', payload_size, frame) + bytes([0 if frame == 0 else 1]) + bytes(payload_size - 1))
+'''
+
+# Stand-in vpxdec/aomdec: writes a blank I420 frame per .ivf frame, and
+# framestats in the same format as vpxdec.
+STAND_IN_DECODER = r'''
+import struct
+import sys
+args = sys.argv[1:]
+decoded_file = args[args.index('-o') + 1]
+framestats_file = [arg.split('=', 1)[1] for arg in args if arg.startswith('--framestats=')][0]
+encoded_file = [arg for arg in args[args.index('-o') + 2:] if not arg.startswith('--')][0]
+with open(encoded_file, 'rb') as f:
+  header = f.read(32)
+  (width, height) = struct.unpack('<HH', header[12:16])
+  frame = bytes(width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2))
+  sizes = []
+  with open(decoded_file, 'wb') as out:
+    while True:
+      frame_header = f.read(12)
+      if len(frame_header) < 12:
+        break
+      (size, _) = struct.unpack('<IQ', frame_header)
+      f.seek(size, 1)
+      sizes.append(size)
+      out.write(frame)
+with open(framestats_file, 'w') as f:
+  f.write('bytes,qp\n')
+  for size in sizes:
+    f.write('%d,32\n' % size)
+'''
+
+# Stand-in tiny_ssim: REFERENCE DECODED WIDTHxHEIGHT TEMPORAL_SKIP FRAMESTATS.
+# Counts decoded frames and reports fixed scores in tiny_ssim's output format.
+STAND_IN_TINY_SSIM = r'''
+import os
+import sys
+(reference_file, decoded_file, size, temporal_skip, framestats_file) = sys.argv[1:6]
+(width, height) = [int(x) for x in size.split('x')]
+num_frames = os.path.getsize(decoded_file) // (width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2))
+for metric in ['AvgPSNR', 'AvgPSNR-Y', 'AvgPSNR-U', 'AvgPSNR-V', 'GlbPSNR', 'GlbPSNR-Y', 'GlbPSNR-U', 'GlbPSNR-V']:
+  print('%s: 40.000' % metric)
+for metric in ['SSIM', 'SSIM-Y', 'SSIM-U', 'SSIM-V', 'VpxSSIM']:
+  print('%s: 0.950' % metric)
+print('Nframes: %d' % num_frames)
+with open(framestats_file, 'w') as f:
+  f.write('psnr,ssim\n')
+  for i in range(num_frames):
+    f.write('%.3f,%.3f\n' % (40 + i % 5, 0.95))
+'''
+
+STAGES = ['prepare-clips', 'generate-jobs', 'run-jobs', 'write-results', 'generate-graphs']
+TOOL_STAGES = ['encode', 'decode', 'metrics']
+
+clip_size_pattern = re.compile(r"^(\d+)x(\d+):(\d+)$")
+def clip_sizes(string):
+  sizes = []
+  for size in string.split(','):
+    match = clip_size_pattern.match(size)
+    if not match:
+      raise argparse.ArgumentTypeError("'%s' is not a valid WIDTHxHEIGHT:FRAMES clip size." % size)
+    sizes.append(tuple(int(x) for x in match.groups()))
+  return sizes
+
+
+def stand_in_encoder_pairs(string):
+  pairs = generate_data.encoder_pairs(string)
+  for (encoder, codec) in pairs:
+    # Stand-ins only write .ivf files, which H.264 decoders can't be pointed at.
+    if codec == 'h264':
+      raise argparse.ArgumentTypeError("'%s:%s' has no stand-in decoder." % (encoder, codec))
+  return pairs
+
+
+parser = argparse.ArgumentParser(description='Benchmark harness overhead of generate_data.py and generate_graphs.py with stand-in codecs.')
+parser.add_argument('--clips', default=[(176, 144, 60), (640, 360, 60), (1280, 720, 30)], type=clip_sizes, metavar='WxH:FRAMES,...', help='sizes of synthetic clips to generate')
+parser.add_argument('--encoders', default=[('libvpx-rt', 'vp8'), ('libvpx-rt', 'vp9')], type=stand_in_encoder_pairs, metavar='encoder:codec,encoder:codec...', help='encoder entries to replace with the stand-in encoder')
+parser.add_argument('--num-temporal-layers', type=int, default=1, choices=[1,2,3])
+parser.add_argument('--out', default=None, metavar='benchmark.json', type=argparse.FileType('w'), help='write results to a file instead of stdout')
+parser.add_argument('--repetitions', default=3, type=generate_data.positive_int, help='number of times each stage is timed, medians are reported')
+parser.add_argument('--skip-graphs', action='store_true', help="don't time generate_graphs.py, which needs matplotlib")
+
+
+def write_synthetic_clip(filename, width, height, num_frames):
+  # Gradients that move from frame to frame, so that clips aren't all zeros.
+  chroma_size = 2 * ((width + 1) // 2) * ((height + 1) // 2)
+  with open(filename, 'wb') as f:
+    for i in range(num_frames):
+      row = bytes((x + 3 * i) & 0xff for x in range(width))
+      f.write(row * height)
+      f.write(bytes([(128 + i) & 0xff]) * chroma_size)
+
+
+def write_stand_in(filename, source):
+  with open(filename, 'w') as f:
+    f.write('#!%s\n%s' % (sys.executable, source))
+  os.chmod(filename, 0o755)
+
+
+def install_stand_ins(work_dir):
+  # Decoders and tiny_ssim are run by paths relative to the working directory,
+  # which becomes |work_dir|.
+  stand_ins = {
+    'stand-in/encoder': STAND_IN_ENCODER,
+    'libvpx/vpxdec': STAND_IN_DECODER,
+    'aom/aomdec': STAND_IN_DECODER,
+    'libvpx/tools/tiny_ssim': STAND_IN_TINY_SSIM,
+  }
+  for (binary, source) in stand_ins.items():
+    path = os.path.join(work_dir, binary)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_stand_in(path, source)
+    generate_data.binary_absolute_paths[binary] = path
+  for encoder in list(generate_data.encoder_commands):
+    generate_data.encoder_commands[encoder] = stand_in_command
+
+
+def stand_in_command(job, temp_dir):
+  clip = job['clip']
+  command = ['stand-in/encoder', generate_data.clip_input_file(job, temp_dir), clip['width'], clip['height'], clip['fps'], job['target_bitrates_kbps'][-1]]
+  encoded_files = []
+  for i in range(job['num_temporal_layers']):
+    (fd, encoded_filename) = tempfile.mkstemp(dir=temp_dir, suffix='.ivf')
+    os.close(fd)
+    layer = {'spatial-layer': 0, 'temporal-layer': i, 'filename': encoded_filename}
+    encoded_files.append(layer)
+    command += [encoded_filename, generate_data.temporal_divide(job, layer)]
+  return ([str(i) for i in command], encoded_files)
+
+
+def timed(times, stage, func, *func_args):
+  start_time = time.monotonic()
+  result = func(*func_args)
+  times[stage] = (time.monotonic() - start_time) * 1000
+  return result
+
+
+def run_jobs(jobs, temp_dir):
+  # Runs jobs and their layers one at a time, so that tool wall times don't
+  # overlap and can be subtracted from the total.
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(1) as layer_executor:
+    for job in jobs:
+      job_temp_dir = tempfile.mkdtemp(dir=temp_dir)
+      (job_results, output) = generate_data.run_command(job, generate_data.job_command(job, job_temp_dir), job_temp_dir, None, layer_executor=layer_executor)
+      if job_results is None:
+        sys.exit("ERROR: Stand-in job failed:\n%s" % output)
+      results += job_results
+  return results
+
+
+def write_results(results, results_file):
+  with open(results_file, 'w') as f:
+    writer = results_io.ResultWriter(f, 'jsonl')
+    writer.begin()
+    for result in results:
+      writer.write(result)
+    writer.end()
+
+
+def generate_graphs(results_file, graph_dir):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_graphs.py')
+  subprocess.check_call([sys.executable, script, '--out-dir', graph_dir, '--formats', 'png', '--force', results_file], stdout=subprocess.DEVNULL)
+
+
+def run_repetition(args, clip_args, work_dir):
+  generate_data.args = generate_data.parser.parse_args(clip_args + [
+    '--out=%s' % os.devnull,
+    '--encoders=%s' % ','.join('%s:%s' % pair for pair in args.encoders),
+    '--num-temporal-layers=%d' % args.num_temporal_layers,
+    '--fingerprint-cache=',
+    '--cost-model=',
+  ])
+  temp_dir = tempfile.mkdtemp(dir=work_dir)
+  times = {}
+  timed(times, 'prepare-clips', generate_data.prepare_clips, generate_data.args)
+  jobs = timed(times, 'generate-jobs', generate_data.generate_jobs, generate_data.args)
+  results = timed(times, 'run-jobs', run_jobs, jobs, temp_dir)
+  results_file = os.path.join(temp_dir, 'results.jsonl')
+  timed(times, 'write-results', write_results, results, results_file)
+  if not args.skip_graphs:
+    graph_dir = os.path.join(temp_dir, 'graphs')
+    os.mkdir(graph_dir)
+    timed(times, 'generate-graphs', generate_graphs, results_file, graph_dir)
+  # Temporal layers share an encode, whose usage is recorded in each of them.
+  tool_ms = 0
+  for stage in TOOL_STAGES:
+    tool_ms += sum(result.get('%s-wall-time-ms' % stage, 0) for result in results if stage != 'encode' or result['temporal-layer'] == 0)
+  shutil.rmtree(temp_dir)
+  return (times, tool_ms, len(jobs), sum(result['frame-count'] for result in results))
+
+
+def summarize(values):
+  return {
+    'wall-time-ms': values,
+    'median-ms': statistics.median(values),
+    'min-ms': min(values),
+    'max-ms': max(values),
+  }
+
+
+def main():
+  args = parser.parse_args()
+  work_dir = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    clip_args = []
+    for (i, (width, height, num_frames)) in enumerate(args.clips):
+      # Sizes may repeat with different frame counts, the index keeps the names
+      # apart while leaving the size last, as generate_data.py expects.
+      clip_file = os.path.join(work_dir, 'synthetic%d_%d_%d.yuv' % (i, width, height))
+      write_synthetic_clip(clip_file, width, height, num_frames)
+      clip_args.append('%s:30' % clip_file)
+    install_stand_ins(work_dir)
+    os.chdir(work_dir)
+
+    times = dict((stage, []) for stage in STAGES)
+    overhead_ms = []
+    for i in range(args.repetitions):
+      # Progress printed by generate_data.py would end up in the results.
+      with contextlib.redirect_stdout(sys.stderr):
+        (repetition_times, tool_ms, num_jobs, num_frames) = run_repetition(args, clip_args, work_dir)
+      for (stage, ms) in repetition_times.items():
+        times[stage].append(ms)
+      overhead_ms.append(repetition_times['run-jobs'] - tool_ms)
+      print("Repetition %d/%d: %d jobs in %.0f ms, %.0f ms outside tools." % (i + 1, args.repetitions, num_jobs, repetition_times['run-jobs'], overhead_ms[-1]), file=sys.stderr)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(work_dir)
+
+  overhead = summarize(overhead_ms)
+  overhead['median-ms-per-job'] = overhead['median-ms'] / num_jobs
+  overhead['median-ms-per-frame'] = overhead['median-ms'] / num_frames
+  benchmark = {
+    'python-version': platform.python_version(),
+    'platform': platform.platform(),
+    'cpu-count': os.cpu_count(),
+    'clips': [{'width': width, 'height': height, 'frames': frames} for (width, height, frames) in args.clips],
+    'encoders': ['%s:%s' % pair for pair in args.encoders],
+    'num-temporal-layers': args.num_temporal_layers,
+    'repetitions': args.repetitions,
+    'jobs': num_jobs,
+    'frames': num_frames,
+    'stages': dict((stage, summarize(values)) for (stage, values) in times.items() if values),
+    'run-jobs-overhead': overhead,
+  }
+  out = args.out or sys.stdout
+  json.dump(benchmark, out, indent=2, sort_keys=True)
+  out.write('\n')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
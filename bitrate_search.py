@@ -0,0 +1,150 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Searches for the target bitrate at which an encoder reaches given quality
+# targets, for generate_data.py --target-quality.
+#
+# Quality is assumed to increase with bitrate and to be roughly linear in log
+# bitrate. Targets are first bracketed by stepping away from measured points,
+# then narrowed down by secant steps between the closest points on each side.
+# All points measured for a clip and encoder are shared between its targets, so
+# later targets usually start out bracketed.
+
+import math
+
+# Target bitrates are multiples of this, which splits evenly into temporal and
+# spatial layer bitrates (see split_temporal_bitrates_kbps in generate_data.py).
+STEP_KBPS = 20
+# Bounds for steps taken while bracketing a target.
+MIN_BRACKET_STEP = 1.25
+MAX_BRACKET_STEP = 4.0
+
+
+def round_kbps(kbps):
+  return max(STEP_KBPS, int(round(kbps / STEP_KBPS)) * STEP_KBPS)
+
+
+def log_interpolate(low, high, value):
+  # Bitrate where the line through (log kbps, quality) points |low| and |high|
+  # reaches |value|.
+  (low_kbps, low_quality) = low
+  (high_kbps, high_quality) = high
+  if high_quality == low_quality:
+    return math.sqrt(low_kbps * high_kbps)
+  t = (value - low_quality) / (high_quality - low_quality)
+  return math.exp(math.log(low_kbps) + t * (math.log(high_kbps) - math.log(low_kbps)))
+
+
+class BitrateSearch(object):
+  # Proposes bitrates to encode one at a time through next_bitrate(), which
+  # returns None once all targets are done. Measured quality (a dict of metric
+  # values, or None for failed encodes) is fed back through add_point().
+  def __init__(self, targets, start_kbps, min_kbps, max_kbps, tolerance, max_encodes):
+    self.targets = list(targets)
+    self.start_kbps = round_kbps(start_kbps)
+    self.min_kbps = round_kbps(min_kbps)
+    self.max_kbps = round_kbps(max_kbps)
+    self.tolerance = tolerance
+    self.max_encodes = max_encodes
+    self.points = {}
+    self.target_encodes = 0
+    self.answers = []
+
+  def add_point(self, kbps, quality):
+    self.points[kbps] = quality
+    self.target_encodes += 1
+
+  def next_bitrate(self):
+    while self.targets:
+      (metric, value) = self.targets[0]
+      kbps = self._propose(metric, value)
+      if kbps is not None and kbps not in self.points and self.target_encodes < self.max_encodes:
+        return kbps
+      self.answers.append(self._answer(metric, value))
+      self.targets.pop(0)
+      self.target_encodes = 0
+    return None
+
+  def _measured(self, metric):
+    return sorted((kbps, quality[metric]) for (kbps, quality) in self.points.items() if quality and metric in quality)
+
+  def _bracket(self, metric, value):
+    # Closest measured points below and at or above the target.
+    points = self._measured(metric)
+    below = [point for point in points if point[1] < value]
+    above = [point for point in points if point[1] >= value]
+    # Ties in quality (flat or saturated metrics) go to the bitrate closest to
+    # the other side, so that steps move away from all of them.
+    low = max(below, key=lambda point: (point[1], point[0])) if below else None
+    high = min(above, key=lambda point: (point[1], -point[0])) if above else None
+    return (points, low, high)
+
+  def _propose(self, metric, value):
+    (points, low, high) = self._bracket(metric, value)
+    if not points:
+      return self.start_kbps
+    if low and high:
+      if high[0] <= low[0] * (1 + self.tolerance):
+        return None
+      kbps = round_kbps(log_interpolate(low, high, value))
+      # Secant steps landing next to a measured point don't narrow it down.
+      if min(abs(kbps - low[0]) / low[0], abs(high[0] - kbps) / high[0]) <= self.tolerance:
+        return None
+      if kbps in self.points:
+        # Measured before without narrowing the bracket (a failed encode or
+        # non-monotonic quality), bisect instead.
+        kbps = round_kbps(math.sqrt(low[0] * high[0]))
+        if kbps in self.points or not low[0] < kbps < high[0]:
+          return None
+      return kbps
+    if low:
+      # Every point is below the target, step up from the highest one.
+      step = self._bracket_step(points, value, low)
+      return self._step_from(low[0], step, self.max_kbps)
+    step = self._bracket_step(points, value, high)
+    return self._step_from(high[0], 1 / step, self.min_kbps)
+
+  def _step_from(self, kbps, step, bound):
+    # Steps from |kbps| towards |bound| until reaching a bitrate that hasn't
+    # been measured yet. Measured bitrates on the way didn't reach the target
+    # (or failed), so they don't bracket it.
+    while (kbps < bound) if step > 1 else (kbps > bound):
+      if step > 1:
+        kbps = min(bound, max(kbps + STEP_KBPS, round_kbps(kbps * step)))
+      else:
+        kbps = max(bound, min(kbps - STEP_KBPS, round_kbps(kbps * step)))
+      if kbps not in self.points:
+        return kbps
+    return None
+
+  def _bracket_step(self, points, value, nearest):
+    # Extrapolates along the two points nearest to the target when they slope
+    # upwards, otherwise doubles or halves the bitrate.
+    step = 2.0
+    others = [point for point in points if point[0] != nearest[0]]
+    if others:
+      other = min(others, key=lambda point: abs(point[0] - nearest[0]))
+      if (other[1] - nearest[1]) * (other[0] - nearest[0]) > 0:
+        step = log_interpolate(nearest, other, value) / nearest[0]
+        step = max(step, 1 / step)
+    return min(MAX_BRACKET_STEP, max(MIN_BRACKET_STEP, step))
+
+  def _answer(self, metric, value):
+    (points, low, high) = self._bracket(metric, value)
+    answer = {'metric': metric, 'target': value, 'encodes': len(self.points), 'bracketed': bool(low and high)}
+    if low and high:
+      answer['bitrate-kbps'] = log_interpolate(low, high, value)
+    else:
+      answer['bitrate-kbps'] = None
+    return answer
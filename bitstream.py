@@ -0,0 +1,276 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-frame payload sizes, frame types and timestamps read straight from encoded
+# files (.ivf, .webm and H.264 Annex-B .264), without decoding them.
+#
+# Frames are (timestamp in seconds, payload bytes, keyframe) tuples, in file
+# order. Timestamps are None for Annex-B streams, which don't carry any.
+
+import mmap
+import os
+import struct
+
+IVF_SIGNATURE = b'DKIF'
+IVF_FRAME_HEADER = struct.Struct('<IQ')
+
+# Matroska element IDs, with their length marker bits.
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_CLUSTER = 0x1F43B675
+EBML_TIMECODE = 0xE7
+EBML_BLOCK_GROUP = 0xA0
+EBML_BLOCK = 0xA1
+EBML_REFERENCE_BLOCK = 0xFB
+EBML_SIMPLE_BLOCK = 0xA3
+# Elements whose children are parsed instead of skipped over.
+EBML_MASTERS = [EBML_SEGMENT, EBML_INFO, EBML_CLUSTER, EBML_BLOCK_GROUP]
+
+H264_NAL_SLICE = 1
+H264_NAL_IDR_SLICE = 5
+H264_NAL_SEI = 6
+H264_NAL_SPS = 7
+H264_NAL_PPS = 8
+H264_NAL_AUD = 9
+
+
+def vp8_keyframe(payload):
+  return len(payload) > 0 and payload[0] & 0x01 == 0
+
+
+def vp9_keyframe(payload):
+  # Uncompressed header: frame marker (2 bits), profile (2 bits, plus a reserved
+  # bit for profile 3), show_existing_frame and frame_type.
+  if not payload:
+    return False
+  bits = payload[0]
+  profile = ((bits >> 5) & 1) | (((bits >> 4) & 1) << 1)
+  shift = 3 if profile < 3 else 2
+  if (bits >> shift) & 1:
+    return False
+  return (bits >> (shift - 1)) & 1 == 0
+
+
+def av1_keyframe(payload):
+  # Temporal units starting a coded video sequence carry a sequence header OBU.
+  offset = 0
+  while offset < len(payload):
+    obu_header = payload[offset]
+    obu_type = (obu_header >> 3) & 0x0F
+    if obu_type == 1:
+      return True
+    has_extension = (obu_header >> 2) & 1
+    has_size = (obu_header >> 1) & 1
+    if not has_size:
+      return False
+    offset += 1 + has_extension
+    (obu_size, offset) = read_leb128(payload, offset)
+    offset += obu_size
+  return False
+
+
+def read_leb128(data, offset):
+  value = 0
+  for i in range(8):
+    byte = data[offset + i]
+    value |= (byte & 0x7F) << (7 * i)
+    if not byte & 0x80:
+      return (value, offset + i + 1)
+  raise ValueError("Invalid leb128 value.")
+
+
+keyframe_parsers = {
+  b'VP80': vp8_keyframe,
+  b'VP90': vp9_keyframe,
+  b'AV01': av1_keyframe,
+}
+
+
+def vp9_superframe_sizes(payload):
+  # Sizes of the frames packed into a VP9 superframe (one per spatial layer for
+  # SVC streams), from the index at its end. Plain frames are a single frame.
+  if not payload:
+    return []
+  marker = payload[-1]
+  if marker & 0xE0 == 0xC0:
+    num_frames = (marker & 0x7) + 1
+    size_bytes = ((marker >> 3) & 0x3) + 1
+    index_size = 2 + size_bytes * num_frames
+    if len(payload) >= index_size and payload[-index_size] == marker:
+      index = payload[-index_size + 1:-1]
+      return [int.from_bytes(index[i * size_bytes:(i + 1) * size_bytes], 'little') for i in range(num_frames)]
+  return [len(payload)]
+
+
+def read_ivf_frames(f, spatial_layer=None):
+  header = f.read(32)
+  if len(header) < 32 or header[:4] != IVF_SIGNATURE:
+    raise ValueError("Not an IVF file.")
+  header_size = struct.unpack('<H', header[6:8])[0]
+  fourcc = header[8:12]
+  (timebase_den, timebase_num) = struct.unpack('<II', header[16:24])
+  keyframe = keyframe_parsers.get(fourcc)
+  f.seek(header_size)
+  frames = []
+  while True:
+    frame_header = f.read(IVF_FRAME_HEADER.size)
+    if len(frame_header) < IVF_FRAME_HEADER.size:
+      break
+    (size, pts) = IVF_FRAME_HEADER.unpack(frame_header)
+    if spatial_layer is None:
+      # Only the start of each frame is needed to tell its type.
+      payload = f.read(min(size, 64))
+      if len(payload) < min(size, 64):
+        break
+      f.seek(size - len(payload), os.SEEK_CUR)
+    else:
+      # Spatial layers only need the frames of lower layers to be decoded.
+      payload = f.read(size)
+      if len(payload) < size:
+        break
+      size = sum(vp9_superframe_sizes(payload)[:spatial_layer + 1])
+    frames.append((float(pts) * timebase_num / timebase_den if timebase_den else None, size, keyframe(payload) if keyframe else False))
+  return frames
+
+
+def read_ebml_vint(data, offset, keep_marker):
+  first = data[offset]
+  length = 1
+  while length <= 8 and not first & (0x80 >> (length - 1)):
+    length += 1
+  if length > 8:
+    raise ValueError("Invalid EBML variable-size integer.")
+  value = first if keep_marker else first & (0xFF >> length)
+  for byte in data[offset + 1:offset + length]:
+    value = (value << 8) | byte
+  # All ones (besides the marker) means the size is unknown.
+  unknown = not keep_marker and value == (1 << (7 * length)) - 1
+  return (None if unknown else value, offset + length)
+
+
+def read_uint(data, offset, size):
+  return int.from_bytes(data[offset:offset + size], 'big')
+
+
+def read_webm_frames(data):
+  if read_uint(data, 0, 4) != 0x1A45DFA3:
+    raise ValueError("Not a WebM file.")
+  frames = []
+  timecode_scale = 1000000
+  cluster_timecode = 0
+  # Blocks in a BlockGroup are keyframes unless the group references other
+  # blocks, which is only known once the whole group has been read.
+  group_block = None
+  group_end = 0
+  offset = 0
+  while offset < len(data):
+    if group_block and offset >= group_end:
+      frames.append(group_block)
+      group_block = None
+    (element_id, offset) = read_ebml_vint(data, offset, True)
+    (size, offset) = read_ebml_vint(data, offset, False)
+    if element_id in EBML_MASTERS:
+      if element_id == EBML_BLOCK_GROUP:
+        group_end = len(data) if size is None else offset + size
+      continue
+    if size is None:
+      raise ValueError("Unknown size for non-master element.")
+    if element_id == EBML_TIMECODE_SCALE:
+      timecode_scale = read_uint(data, offset, size)
+    elif element_id == EBML_TIMECODE:
+      cluster_timecode = read_uint(data, offset, size)
+    elif element_id in [EBML_SIMPLE_BLOCK, EBML_BLOCK]:
+      (_, payload_offset) = read_ebml_vint(data, offset, False)
+      relative_timecode = struct.unpack('>h', data[payload_offset:payload_offset + 2])[0]
+      flags = data[payload_offset + 2]
+      payload_offset += 3
+      timestamp = (cluster_timecode + relative_timecode) * timecode_scale / 1e9
+      payload_size = offset + size - payload_offset
+      if element_id == EBML_SIMPLE_BLOCK:
+        frames.append((timestamp, payload_size, bool(flags & 0x80)))
+      else:
+        group_block = (timestamp, payload_size, True)
+    elif element_id == EBML_REFERENCE_BLOCK and group_block:
+      group_block = group_block[:2] + (False,)
+    offset += size
+  if group_block:
+    frames.append(group_block)
+  # Blocks are stored in decode order, which is what frame-bytes uses too.
+  return frames
+
+
+def annexb_nal_units(data):
+  # Yields (offset, end) of NAL units between start codes, without start codes
+  # or trailing zero bytes.
+  start = data.find(b'\x00\x00\x01')
+  while start != -1:
+    nal_start = start + 3
+    next_start = data.find(b'\x00\x00\x01', nal_start)
+    end = len(data) if next_start == -1 else next_start
+    while end > nal_start and data[end - 1] == 0:
+      end -= 1
+    if end > nal_start:
+      yield (nal_start, end)
+    start = next_start
+
+
+def read_annexb_frames(data):
+  # Groups NAL units into access units (H.264 7.4.1.2.3): parameter sets, SEI
+  # and delimiters start a new access unit after a slice, as does a slice with
+  # first_mb_in_slice == 0.
+  frames = []
+  size = 0
+  keyframe = False
+  has_slice = False
+  for (start, end) in annexb_nal_units(data):
+    nal_type = data[start] & 0x1F
+    is_slice = nal_type in [H264_NAL_SLICE, H264_NAL_IDR_SLICE]
+    # first_mb_in_slice is ue(v) coded, so it's 0 iff its first bit is set.
+    first_slice = is_slice and end > start + 1 and data[start + 1] & 0x80
+    starts_access_unit = has_slice and (nal_type in [H264_NAL_SEI, H264_NAL_SPS, H264_NAL_PPS, H264_NAL_AUD] or first_slice)
+    if starts_access_unit:
+      frames.append((None, size, keyframe))
+      size = 0
+      keyframe = False
+      has_slice = False
+    size += end - start
+    if is_slice:
+      has_slice = True
+      keyframe = keyframe or nal_type == H264_NAL_IDR_SLICE
+  if has_slice:
+    frames.append((None, size, keyframe))
+  return frames
+
+
+def read_frames(filename, spatial_layer=None):
+  # Raises ValueError for files that can't be parsed. For VP9 SVC streams in
+  # .ivf files, |spatial_layer| counts only the bytes needed to decode up to
+  # that spatial layer.
+  extension = os.path.splitext(filename)[1]
+  if extension == '.ivf':
+    with open(filename, 'rb') as f:
+      return read_ivf_frames(f, spatial_layer)
+  if extension not in ['.webm', '.264']:
+    raise ValueError("Unsupported file type '%s'." % extension)
+  if os.path.getsize(filename) == 0:
+    return []
+  with open(filename, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      try:
+        if extension == '.webm':
+          return read_webm_frames(data)
+        return read_annexb_frames(data)
+      except (IndexError, struct.error):
+        raise ValueError("Truncated or corrupt file '%s'." % filename)
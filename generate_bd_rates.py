@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import csv
+import itertools
+import sys
+import time
+
+import numpy as np
+
+import results_io
+
+METRICS = [
+  'vpx-ssim',
+  'ssim',
+  'ssim-y',
+  'ssim-u',
+  'ssim-v',
+  'avg-psnr',
+  'avg-psnr-y',
+  'avg-psnr-u',
+  'avg-psnr-v',
+  'glb-psnr',
+  'glb-psnr-y',
+  'glb-psnr-u',
+  'glb-psnr-v',
+  'vmaf',
+]
+
+FITS = ['cubic', 'pchip']
+
+FIELDS = [
+  'input-file',
+  'layer-pattern',
+  'bitrate-config',
+  'spatial-layer',
+  'temporal-layer',
+  'metric',
+  'anchor',
+  'test',
+  'bd-rate-percent',
+  'bd-quality',
+]
+
+
+def metric_list(metrics_string):
+  metrics = metrics_string.split(',')
+  for metric in metrics:
+    if metric not in METRICS:
+      raise argparse.ArgumentTypeError("'%s' is not a supported metric.\n" % metric)
+  return metrics
+
+
+parser = argparse.ArgumentParser(description='Compute Bjontegaard-delta rates and quality between encoders.')
+parser.add_argument('graph_files', nargs='+', metavar='graph_file.jsonl', type=argparse.FileType('r'))
+parser.add_argument('--out', default=sys.stdout, type=argparse.FileType('w'), metavar='bd-rates.csv', help='output file, defaults to stdout')
+parser.add_argument('--metrics', type=metric_list, default=METRICS, metavar='ssim,avg-psnr,...', help='comma-separated list of quality metrics')
+parser.add_argument('--anchor', metavar='encoder:codec', help='only compare against this encoder:codec')
+parser.add_argument('--fit', choices=FITS, default='cubic', help='curve fit, cubic polynomials (classic BD-rate) or piecewise-cubic interpolation')
+
+
+def normalize_bitrate_config_string(config):
+  return ":".join([str(int(x * 100.0 / config[-1])) for x in config])
+
+
+def index_curves(graph_data):
+  # Maps (input-file, layer-pattern, bitrate-config, spatial-layer,
+  # temporal-layer) to {encoder:codec: {target-bitrate-bps: point}}. Later points
+  # for the same target bitrate replace earlier ones.
+  curves = {}
+  for point in graph_data:
+    curve_key = (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['spatial-layer'], point['temporal-layer'])
+    encoder = '%s:%s' % (point['encoder'], point['codec'])
+    curves.setdefault(curve_key, {}).setdefault(encoder, {})[point['target-bitrate-bps']] = point
+  return curves
+
+
+def curve_points(points, metric):
+  # Returns (log10 rates, quality) for a curve, or None if it can't be used.
+  if len(points) < 2 or any(metric not in point for point in points.values()):
+    return None
+  rates = np.array([point['actual-bitrate-bps'] for point in points.values()], dtype=np.float64)
+  quality = np.array([point[metric] for point in points.values()], dtype=np.float64)
+  if np.any(rates <= 0):
+    return None
+  return (np.log10(rates), quality)
+
+
+def sort_points(x, y):
+  order = np.argsort(x, axis=1, kind='stable')
+  return (np.take_along_axis(x, order, axis=1), np.take_along_axis(y, order, axis=1))
+
+
+def cubic_integrals(x, y, lo, hi):
+  # Least-squares polynomials (cubic, or lower degree for curves with fewer
+  # than 4 points) through each row of (x, y), integrated over [lo, hi].
+  degree = min(3, x.shape[1] - 1)
+  powers = np.arange(degree + 1)
+  vandermonde = x[:, :, None] ** powers
+  coefs = np.matmul(np.linalg.pinv(vandermonde), y[:, :, None])[:, :, 0]
+  antiderivative = lambda v: np.sum(coefs * v[:, None] ** (powers + 1) / (powers + 1), axis=1)
+  return antiderivative(hi) - antiderivative(lo)
+
+
+def pchip_slopes(h, delta):
+  # Monotonicity-preserving derivatives at each point (Fritsch-Carlson, with
+  # the same end conditions as scipy.interpolate.PchipInterpolator).
+  (batch, segments) = delta.shape
+  slopes = np.zeros((batch, segments + 1))
+  if segments == 1:
+    slopes[:, 0] = delta[:, 0]
+    slopes[:, 1] = delta[:, 0]
+    return slopes
+  w1 = 2 * h[:, 1:] + h[:, :-1]
+  w2 = h[:, 1:] + 2 * h[:, :-1]
+  same_sign = delta[:, :-1] * delta[:, 1:] > 0
+  with np.errstate(divide='ignore', invalid='ignore'):
+    harmonic = (w1 + w2) / (w1 / delta[:, :-1] + w2 / delta[:, 1:])
+  slopes[:, 1:-1] = np.where(same_sign, harmonic, 0.0)
+  for (end, h0, h1, d0, d1) in [(0, h[:, 0], h[:, 1], delta[:, 0], delta[:, 1]),
+                               (-1, h[:, -1], h[:, -2], delta[:, -1], delta[:, -2])]:
+    slope = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+    slope = np.where(np.sign(slope) != np.sign(d0), 0.0, slope)
+    slope = np.where((np.sign(d0) != np.sign(d1)) & (np.abs(slope) > np.abs(3 * d0)), 3 * d0, slope)
+    slopes[:, end] = slope
+  return slopes
+
+
+def pchip_integrals(x, y, lo, hi):
+  # Piecewise-cubic Hermite interpolation through each row of (x, y), which
+  # must be strictly increasing in x, integrated over [lo, hi].
+  h = np.diff(x, axis=1)
+  delta = np.diff(y, axis=1) / h
+  slopes = pchip_slopes(h, delta)
+  c2 = (3 * delta - 2 * slopes[:, :-1] - slopes[:, 1:]) / h
+  c3 = (slopes[:, :-1] + slopes[:, 1:] - 2 * delta) / h ** 2
+  # Integrate each segment over its overlap with [lo, hi], in coordinates
+  # relative to the segment start.
+  start = np.clip(lo[:, None], x[:, :-1], x[:, 1:]) - x[:, :-1]
+  end = np.clip(hi[:, None], x[:, :-1], x[:, 1:]) - x[:, :-1]
+  antiderivative = lambda s: y[:, :-1] * s + slopes[:, :-1] * s ** 2 / 2 + c2 * s ** 3 / 3 + c3 * s ** 4 / 4
+  return np.sum(antiderivative(end) - antiderivative(start), axis=1)
+
+
+def average_differences(anchor_x, anchor_y, test_x, test_y, fit):
+  # Average vertical distance between test and anchor curves over the range
+  # where their x values overlap, for a batch of curve pairs. NaN where curves
+  # don't overlap or can't be fitted.
+  (anchor_x, anchor_y) = sort_points(anchor_x, anchor_y)
+  (test_x, test_y) = sort_points(test_x, test_y)
+  lo = np.maximum(anchor_x[:, 0], test_x[:, 0])
+  hi = np.minimum(anchor_x[:, -1], test_x[:, -1])
+  valid = hi > lo
+  if fit == 'pchip':
+    valid &= np.all(np.diff(anchor_x, axis=1) > 0, axis=1) & np.all(np.diff(test_x, axis=1) > 0, axis=1)
+  integrals = pchip_integrals if fit == 'pchip' else cubic_integrals
+  # Invalid rows are computed over a dummy range and masked out afterwards.
+  safe_lo = np.where(valid, lo, anchor_x[:, 0])
+  safe_hi = np.where(valid, hi, anchor_x[:, 0] + 1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    difference = (integrals(test_x, test_y, safe_lo, safe_hi) - integrals(anchor_x, anchor_y, safe_lo, safe_hi)) / (safe_hi - safe_lo)
+  return np.where(valid, difference, np.nan)
+
+
+def bd_metrics(pairs, fit):
+  # |pairs| is a list of ((anchor_rates, anchor_quality), (test_rates,
+  # test_quality)) with log10 rates. Pairs are batched by their number of
+  # points. Returns a list of (bd-rate percent, bd-quality).
+  results = [None] * len(pairs)
+  batches = {}
+  for (i, (anchor, test)) in enumerate(pairs):
+    batches.setdefault((len(anchor[0]), len(test[0])), []).append(i)
+  for indices in batches.values():
+    (anchor_rates, anchor_quality) = [np.stack([pairs[i][0][j] for i in indices]) for j in (0, 1)]
+    (test_rates, test_quality) = [np.stack([pairs[i][1][j] for i in indices]) for j in (0, 1)]
+    # BD-rate integrates log rate over quality, BD-quality quality over log rate.
+    log_rate_difference = average_differences(anchor_quality, anchor_rates, test_quality, test_rates, fit)
+    quality_difference = average_differences(anchor_rates, anchor_quality, test_rates, test_quality, fit)
+    bd_rates = (10 ** log_rate_difference - 1) * 100
+    for (k, i) in enumerate(indices):
+      results[i] = (bd_rates[k], quality_difference[k])
+  return results
+
+
+def format_value(value):
+  return '' if np.isnan(value) else '%.4f' % value
+
+
+def main():
+  args = parser.parse_args()
+  start_time = time.time()
+  graph_data = []
+  for f in args.graph_files:
+    graph_data += results_io.read_results(f)
+
+  rows = []
+  pairs = []
+  for (curve_key, encoders) in sorted(index_curves(graph_data).items()):
+    for (anchor, test) in itertools.permutations(sorted(encoders), 2):
+      if args.anchor and anchor != args.anchor:
+        continue
+      # Without an explicit anchor, each pair is reported once.
+      if not args.anchor and anchor > test:
+        continue
+      for metric in args.metrics:
+        anchor_points = curve_points(encoders[anchor], metric)
+        test_points = curve_points(encoders[test], metric)
+        if anchor_points is None or test_points is None:
+          continue
+        rows.append(curve_key + (metric, anchor, test))
+        pairs.append((anchor_points, test_points))
+
+  writer = csv.writer(args.out, lineterminator='\n')
+  writer.writerow(FIELDS)
+  for (row, (bd_rate, bd_quality)) in zip(rows, bd_metrics(pairs, args.fit)):
+    writer.writerow(list(row) + [format_value(bd_rate), format_value(bd_quality)])
+  args.out.flush()
+  print("Computed %d BD-rates in %.2fs." % (len(rows), time.time() - start_time), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -14,18 +14,38 @@
 # limitations under the License.
 
 import argparse
+import concurrent.futures
 import csv
+import errno
+import hashlib
 import json
+import math
 import multiprocessing
 import os
-import pprint
 import re
+import resource
 import shutil
+import statistics
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+import traceback
+
+import bitrate_search
+import bitstream
+import preview
+import result_cache
+import results_io
+import scheduler
+import telemetry
+import y4m
+
+try:
+  import yuv_metrics
+except ImportError:
+  yuv_metrics = None
 
 libvpx_threads = 4
 
@@ -51,6 +71,23 @@ def find_absolute_path(use_system_path, binary):
 
   sys.exit("ERROR: '%s' missing, did you run the corresponding setup script?" % (os.path.basename(binary) if use_system_path else target))
 
+def file_sha1(filename):
+  # hashlib releases the GIL for large updates, so this runs in parallel when
+  # called from multiple threads.
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(4 * 1024 * 1024), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+binary_hashes = {}
+
+def binary_hash(binary):
+  global binary_hashes
+  if binary not in binary_hashes:
+    binary_hashes[binary] = file_sha1(binary)
+  return binary_hashes[binary]
+
 def aom_command(job, temp_dir):
   assert job['num_spatial_layers'] == 1
   assert job['num_temporal_layers'] == 1
@@ -97,8 +134,13 @@ def aom_command(job, temp_dir):
     '--width=%d' % clip['width'],
     '--height=%d' % clip['height'],
     '--output=%s' % encoded_filename,
-    clip['yuv_file'],
   ]
+  # Two-pass encodes need to read the input twice, so the clip window is
+  # selected by aomenc itself instead of being streamed through a FIFO. aomenc
+  # reads .y4m clips natively.
+  if clip_window_is_partial(clip):
+    command += ['--skip=%d' % clip['frame_offset'], '--limit=%d' % clip['num_frames']]
+  command.append(clip['yuv_file'])
   encoded_files = [{'spatial-layer': 0, 'temporal-layer': 0, 'filename': encoded_filename}]
   return (command, encoded_files)
 
@@ -115,7 +157,7 @@ def libvpx_tl_command(job, temp_dir):
 
   command = [
       'libvpx/examples/vpx_temporal_svc_encoder',
-      clip['yuv_file'],
+      clip_input_file(job, temp_dir),
       outfile_prefix,
       job['codec'],
       clip['width'],
@@ -132,9 +174,49 @@ def libvpx_tl_command(job, temp_dir):
 
   return ([str(i) for i in command], encoded_files)
 
+def libvpx_svc_command(job, temp_dir):
+  # Parameters are intended to be as close as possible to realtime settings used
+  # in WebRTC.
+  assert job['codec'] == 'vp9'
+  assert job['num_temporal_layers'] == 1
+  num_spatial_layers = job['num_spatial_layers']
+
+  (fd, encoded_filename) = tempfile.mkstemp(dir=temp_dir, suffix=".ivf")
+  os.close(fd)
+
+  clip = job['clip']
+  fps = int(clip['fps'] + 0.5)
+  # Target bitrates are cumulative, the encoder takes one per spatial layer.
+  bitrates_kbps = job['target_bitrates_kbps']
+  layer_bitrates_kbps = [bitrates_kbps[0]] + [bitrates_kbps[i] - bitrates_kbps[i - 1] for i in range(1, num_spatial_layers)]
+
+  command = [
+    'libvpx/examples/vp9_spatial_svc_encoder',
+    '-w', clip['width'],
+    '-h', clip['height'],
+    '-t', '1/%d' % fps,
+    '-sl', num_spatial_layers,
+    '-tl', 1,
+    '-r', ','.join('1/%d' % 2 ** (num_spatial_layers - 1 - i) for i in range(num_spatial_layers)),
+    '-b', bitrates_kbps[-1],
+    '-bl', ','.join(str(i) for i in layer_bitrates_kbps),
+    '-sp', 7,
+    '-aq', 3,
+    '-th', libvpx_threads,
+    '-k', 3000,
+    '-f', clip['num_frames'],
+    '-o', encoded_filename,
+    clip_input_file(job, temp_dir),
+  ]
+  # All spatial layers are in the same file, decoding picks the layer to output.
+  encoded_files = [{'spatial-layer': i, 'temporal-layer': 0, 'filename': encoded_filename} for i in range(num_spatial_layers)]
+  return ([str(i) for i in command], encoded_files)
+
 def libvpx_command(job, temp_dir):
   # Parameters are intended to be as close as possible to realtime settings used
   # in WebRTC.
+  if job['num_spatial_layers'] > 1:
+    return libvpx_svc_command(job, temp_dir)
   if (job['num_temporal_layers'] > 1):
     return libvpx_tl_command(job, temp_dir)
   assert job['num_spatial_layers'] == 1
@@ -191,7 +273,7 @@ def libvpx_command(job, temp_dir):
     '--width=%d' % clip['width'],
     '--height=%d' % clip['height'],
     '--output=%s' % encoded_filename,
-    clip['yuv_file']
+    clip_input_file(job, temp_dir)
   ]
   encoded_files = [{'spatial-layer': 0, 'temporal-layer': 0, 'filename': encoded_filename}]
   return (command, encoded_files)
@@ -220,7 +302,7 @@ def openh264_command(job, temp_dir):
     '-sw', clip['width'],
     '-sh', clip['height'],
     '-frin', clip['fps'],
-    '-org', clip['yuv_file'],
+    '-org', clip_input_file(job, temp_dir),
     '-bf', encoded_filename,
     '-numl', 1,
     '-dw', 0, clip['width'],
@@ -251,7 +333,7 @@ def yami_command(job, temp_dir):
     '--ipperiod', 1,
     '--intraperiod', 3000,
     '-c', job['codec'].upper(),
-    '-i', clip['yuv_file'],
+    '-i', clip_input_file(job, temp_dir),
     '-W', clip['width'],
     '-H', clip['height'],
     '-f', fps,
@@ -273,10 +355,11 @@ yuv_clip_pattern = re.compile(r"^(.*[\._](\d+)_(\d+).yuv):(\d+)$")
 def clip_arg(clip):
   (file_root, file_ext) = os.path.splitext(clip)
   if file_ext == '.y4m':
-    width = int(subprocess.check_output(["mediainfo", "--Inform=Video;%Width%", clip]))
-    height = int(subprocess.check_output(["mediainfo", "--Inform=Video;%Height%", clip]))
-    fps = float(subprocess.check_output(["mediainfo", "--Inform=Video;%FrameRate%", clip]))
-    return {'input_file': clip, 'height': height, 'width': width, 'fps': fps, 'file_type': 'y4m'}
+    try:
+      header = y4m.read_header(clip)
+    except (IOError, OSError, ValueError) as e:
+      raise argparse.ArgumentTypeError("%s\n" % e)
+    return {'input_file': clip, 'height': header['height'], 'width': header['width'], 'fps': header['fps'], 'file_type': 'y4m'}
 
   # Make sure YUV files are correctly formatted + look readable before actually
   # running the script on them.
@@ -308,6 +391,32 @@ def writable_dir(directory):
   return directory
 
 
+shard_pattern = re.compile(r"^(\d+)/(\d+)$")
+def shard_arg(shard):
+  shard_match = shard_pattern.match(shard)
+  if not shard_match or int(shard_match.group(1)) >= int(shard_match.group(2)):
+    raise argparse.ArgumentTypeError("'%s' is not a shard of the form INDEX/COUNT with INDEX < COUNT.\n" % shard)
+  return (int(shard_match.group(1)), int(shard_match.group(2)))
+
+
+def writable_file(filename):
+  # The file itself is created later on, its directory has to exist already.
+  writable_dir(os.path.dirname(os.path.abspath(filename)))
+  return filename
+
+
+def optional_writable_dir(directory):
+  # An empty argument disables the directory.
+  return writable_dir(directory) if directory else None
+
+
+def non_negative_int(num):
+  num_int = int(num)
+  if num_int < 0:
+    raise argparse.ArgumentTypeError("'%s' is not a non-negative integer.\n" % num)
+  return num_int
+
+
 def positive_int(num):
   num_int = int(num)
   if num_int <= 0:
@@ -315,71 +424,396 @@ def positive_int(num):
   return num_int
 
 
+quality_metrics = ['ssim', 'ssim-y', 'ssim-u', 'ssim-v', 'vpx-ssim', 'avg-psnr', 'avg-psnr-y', 'avg-psnr-u', 'avg-psnr-v', 'glb-psnr', 'glb-psnr-y', 'glb-psnr-u', 'glb-psnr-v', 'vmaf']
+def quality_targets(string):
+  targets = []
+  for target in string.split(','):
+    (metric, _, value) = target.partition('=')
+    if metric not in quality_metrics:
+      raise argparse.ArgumentTypeError("'%s' is not a supported quality metric in '%s'.\n" % (metric, string))
+    try:
+      targets.append((metric, float(value)))
+    except ValueError:
+      raise argparse.ArgumentTypeError("'%s' doesn't match the format METRIC=VALUE.\n" % target)
+  return targets
+
+
+user_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'rtc-video-quality')
+
 parser = argparse.ArgumentParser(description='Generate graph data for video-quality comparison.')
 parser.add_argument('clips', nargs='+', metavar='clip_WIDTH_HEIGHT.yuv:FPS|clip.y4m', type=clip_arg)
+parser.add_argument('--cache-dir', default=None, help='directory of cached job results, jobs with cached results are not rerun')
+parser.add_argument('--cache-encoded-files', action='store_true', help='also store encoded files in --cache-dir')
+parser.add_argument('--cache-max-age-days', default=None, type=positive_int, help='evict cache entries unused for this many days')
+parser.add_argument('--cache-max-size-mb', default=None, type=positive_int, help='evict least recently used cache entries above this size')
+parser.add_argument('--cost-model', default=os.path.join(user_cache_dir, 'job-costs.json'), metavar='FILE', help='file used to learn job costs between runs (for scheduling longest jobs first), empty to disable')
+parser.add_argument('--decode-workers', type=positive_int, default=max(1, multiprocessing.cpu_count() // 4), help='number of concurrently decoded layers')
 parser.add_argument('--dump-commands', action='store_true')
+parser.add_argument('--dump-manifest', default=None, metavar='manifest.jsonl', type=argparse.FileType('w'), help='write the list of jobs to run to a file and exit')
 parser.add_argument('--enable-vmaf', action='store_true')
 parser.add_argument('--encoded-file-dir', default=None, type=writable_dir)
 parser.add_argument('--encoders', required=True, metavar='encoder:codec,encoder:codec...', type=encoder_pairs)
+parser.add_argument('--fingerprint-cache', default=os.path.join(user_cache_dir, 'clip-sha1sums.json'), metavar='FILE', help='file used to cache clip SHA-1 sums between runs, empty to disable')
 parser.add_argument('--frame-offset', default=0, type=positive_int)
+parser.add_argument('--isolated-timing', action='store_true', help='pin each encoder to CPUs of its own and time it over repeated runs')
+parser.add_argument('--manifest', default=None, metavar='manifest.jsonl', type=argparse.FileType('r'), help='only run jobs listed in a file written by --dump-manifest')
+parser.add_argument('--max-encoder-threads', type=positive_int, default=None, help='maximum number of encoder threads used by concurrently running jobs (defaults to the number of cores, or half of them with --isolated-timing)')
+parser.add_argument('--metrics-engine', default='tiny_ssim', choices=['tiny_ssim', 'numpy'], help='compute PSNR/SSIM with libvpx/tools/tiny_ssim or in-process with NumPy')
+parser.add_argument('--metrics-workers', type=positive_int, default=max(1, multiprocessing.cpu_count() // 2), help='number of concurrently measured layers')
 parser.add_argument('--num-frames', default=-1, type=positive_int)
-# TODO(pbos): Add support for multiple spatial layers.
-parser.add_argument('--num-spatial-layers', type=int, default=1, choices=[1])
+parser.add_argument('--num-spatial-layers', type=int, default=1, choices=[1,2,3])
 parser.add_argument('--num-temporal-layers', type=int, default=1, choices=[1,2,3])
-parser.add_argument('--out', required=True, metavar='output.txt', type=argparse.FileType('w'))
+parser.add_argument('--out', required=True, metavar='output.jsonl', type=argparse.FileType('w'))
+parser.add_argument('--out-format', default='jsonl', choices=results_io.FORMATS, help='write results as JSON Lines or as a legacy Python list of dicts')
+parser.add_argument('--preview-segment-frames', default=60, type=positive_int, help='length of segments encoded with --preview-segments')
+parser.add_argument('--preview-segments', default=None, type=positive_int, help='only encode this many short segments per clip, and estimate full-clip results from them')
+parser.add_argument('--scaled-reference-dir', default=None, type=writable_dir, help='directory to keep downscaled source clips for spatial layers in between runs')
+parser.add_argument('--scratch-budget-mb', default=None, type=positive_int, help='disk space used by temp dirs of running jobs, jobs wait for space to free up beyond this (defaults to 90%% of free space)')
+parser.add_argument('--search-max-encodes', default=6, type=positive_int, help='maximum number of encodes per quality target, clip and encoder with --target-quality')
+parser.add_argument('--search-out', default=None, metavar='search.jsonl', type=argparse.FileType('w'), help='write bitrates found with --target-quality to a file')
+parser.add_argument('--search-tolerance', default=0.05, type=float, help='relative bitrate precision searched for with --target-quality')
+parser.add_argument('--shard', default=None, type=shard_arg, metavar='INDEX/COUNT', help='only run every COUNT-th job, starting at INDEX (0-based)')
+parser.add_argument('--shard-dir', default=None, type=writable_dir, help='shared directory of lock files, jobs are claimed by whichever process gets to them first')
+parser.add_argument('--status-file', default=None, metavar='status.json', type=writable_file, help='periodically write run progress as JSON to this file')
+parser.add_argument('--status-interval', default=10, type=positive_int, help='seconds between writes of --status-file')
+parser.add_argument('--stream-decode', action='store_true', help='pipe decoder output directly into --metrics-engine=numpy instead of writing decoded .yuv files')
+parser.add_argument('--target-quality', default=None, metavar='METRIC=VALUE,...', type=quality_targets, help='search for the bitrates reaching these quality targets instead of encoding a fixed set of bitrates')
+parser.add_argument('--telemetry-port', default=None, type=positive_int, help='serve run progress in the Prometheus text format on http://localhost:PORT/metrics')
+parser.add_argument('--timing-repetitions', default=5, type=positive_int, help='number of timed encoder runs with --isolated-timing')
+parser.add_argument('--timing-warmup-runs', default=1, type=non_negative_int, help='number of untimed encoder runs before timed ones with --isolated-timing')
+parser.add_argument('--tmpfs-budget-mb', default=None, type=positive_int, help='space used on --tmpfs-dir by temp dirs of running jobs (defaults to half of its free space)')
+parser.add_argument('--tmpfs-dir', default='/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else '', type=optional_writable_dir, help='RAM-backed directory for temp dirs of jobs that fit, empty to only use TMPDIR')
 parser.add_argument('--use-system-path', action='store_true')
 parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
 
 
-def prepare_clips(args, temp_dir):
+def file_fingerprint_key(filename):
+  stat = os.stat(filename)
+  return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def fingerprint_clips(clips, cache_file, workers):
+  # Computes SHA-1 sums of clip input files in parallel. Sums are cached in
+  # |cache_file| by path and skipped as long as size, mtime and inode match.
+  cache = {}
+  if cache_file and os.path.isfile(cache_file):
+    try:
+      with open(cache_file) as f:
+        cache = json.load(f)
+    except ValueError:
+      print("WARNING: Ignoring unreadable fingerprint cache '%s'." % cache_file)
+  keys = {}
+  to_hash = []
+  for clip in clips:
+    path = os.path.realpath(clip['input_file'])
+    keys[path] = file_fingerprint_key(path)
+    entry = cache.get(path)
+    if (not entry or entry['key'] != keys[path]) and path not in to_hash:
+      to_hash.append(path)
+  if to_hash:
+    print("Hashing %d clip%s..." % (len(to_hash), "" if len(to_hash) == 1 else "s"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+      for (path, sha1sum) in zip(to_hash, executor.map(file_sha1, to_hash)):
+        cache[path] = {'key': keys[path], 'sha1sum': sha1sum}
+    if cache_file:
+      cache_dir = os.path.dirname(os.path.abspath(cache_file))
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      (fd, temp_file) = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+      os.replace(temp_file, cache_file)
+  for clip in clips:
+    clip['sha1sum'] = cache[os.path.realpath(clip['input_file'])]['sha1sum']
+
+
+def prepare_clips(args):
   clips = args.clips
-  y4m_clips = [clip for clip in clips if clip['file_type'] == 'y4m']
-  if y4m_clips:
-    print("Converting %d .y4m clip%s..." % (len(y4m_clips), "" if len(y4m_clips) == 1 else "s"))
-    for clip in y4m_clips:
-      (fd, yuv_file) = tempfile.mkstemp(dir=temp_dir, suffix=".%d_%d.yuv" % (clip['width'], clip['height']))
-      os.close(fd)
-      with open(os.devnull, 'w') as devnull:
-        subprocess.check_call(['ffmpeg', '-y', '-i', clip['input_file'], yuv_file], stdout=devnull, stderr=devnull)
-      clip['yuv_file'] = yuv_file
+  fingerprint_clips(clips, args.fingerprint_cache, args.workers)
   for clip in clips:
-    clip['sha1sum'] = subprocess.check_output(['sha1sum', clip['input_file']]).split(' ', 1)[0]
-    if 'yuv_file' not in clip:
-      clip['yuv_file'] = clip['input_file']
-    frame_size = 6 * clip['width'] * clip['height'] / 4
-    input_yuv_filesize = os.path.getsize(clip['yuv_file'])
-    clip['input_total_frames'] = input_yuv_filesize / frame_size
-    # Truncate file if necessary.
-    if args.frame_offset > 0 or args.num_frames > 0:
-      (fd, truncated_filename) = tempfile.mkstemp(dir=temp_dir, suffix=".yuv")
-      blocksize = 2048 * 1024
-      total_filesize = args.num_frames * frame_size
-      with os.fdopen(fd, 'wb', blocksize) as truncated_file:
-        with open(clip['yuv_file'], 'rb') as original_file:
-          original_file.seek(args.frame_offset * frame_size)
-          while total_filesize > 0:
-            data = original_file.read(blocksize if blocksize < total_filesize else total_filesize)
-            truncated_file.write(data)
-            total_filesize -= blocksize
-      clip['yuv_file'] = truncated_filename
-
-
-def decode_file(job, temp_dir, encoded_file):
-  (fd, decoded_file) = tempfile.mkstemp(dir=temp_dir, suffix=".yuv")
+    # Frames of .y4m clips are read in place, skipping over frame headers.
+    clip['yuv_file'] = clip['input_file']
+    try:
+      (_, _, clip['input_total_frames']) = y4m.frame_layout(clip['yuv_file'], clip['width'], clip['height'])
+    except ValueError as e:
+      sys.exit("ERROR: %s" % e)
+    # Frame window used for this run. Clips aren't truncated on disk, encoders
+    # and metrics read the window straight out of the original file.
+    clip['frame_offset'] = min(args.frame_offset, clip['input_total_frames'])
+    clip['num_frames'] = clip['input_total_frames'] - clip['frame_offset']
+    if args.num_frames > 0:
+      clip['num_frames'] = min(args.num_frames, clip['num_frames'])
+    if clip['num_frames'] == 0:
+      sys.exit("ERROR: No frames of %s to encode (%d frames, --frame-offset=%d)." % (clip['input_file'], clip['input_total_frames'], args.frame_offset))
+
+
+def clip_window_is_partial(clip):
+  return clip['frame_offset'] > 0 or clip['num_frames'] < clip['input_total_frames']
+
+
+def clip_needs_feed(clip):
+  # Tools reading raw I420 can only be given the clip file itself when it's
+  # used whole and has no .y4m headers.
+  return clip['file_type'] == 'y4m' or clip_window_is_partial(clip)
+
+
+def make_fifo(temp_dir, suffix):
+  (fd, fifo) = tempfile.mkstemp(dir=temp_dir, suffix=suffix)
   os.close(fd)
+  os.remove(fifo)
+  os.mkfifo(fifo)
+  return fifo
+
+
+def process_exited(process):
+  # Unlike Popen.poll(), doesn't reap the process, which is left to
+  # wait_for_process() so that its exit status and resource usage are kept.
+  try:
+    return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+  except ChildProcessError:
+    return True
+
+
+def open_fifo_for_writing(fifo, reader_process):
+  # Opening a FIFO for writing blocks until a reader has opened it. Poll instead
+  # so that a reader failing on startup doesn't hang the job.
+  while True:
+    try:
+      fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+      break
+    except OSError as e:
+      if e.errno != errno.ENXIO or process_exited(reader_process):
+        raise
+      time.sleep(0.01)
+  os.set_blocking(fd, True)
+  return os.fdopen(fd, 'wb')
+
+
+def clip_window_ranges(clip):
+  # (offset, size) ranges of the clip file holding the window's I420 frames.
+  # Raw .yuv windows are a single range, .y4m frames are split up by frame
+  # headers.
+  frame_size = y4m.i420_frame_size(clip['width'], clip['height'])
+  (data_offset, stride, _) = y4m.frame_layout(clip['yuv_file'], clip['width'], clip['height'])
+  if stride == frame_size:
+    return [(data_offset + clip['frame_offset'] * frame_size, clip['num_frames'] * frame_size)]
+  return [(data_offset + i * stride, frame_size) for i in range(clip['frame_offset'], clip['frame_offset'] + clip['num_frames'])]
+
+
+def send_clip_window(clip, source, sink):
+  for (offset, remaining) in clip_window_ranges(clip):
+    while remaining > 0:
+      sent = os.sendfile(sink.fileno(), source.fileno(), offset, remaining)
+      if sent == 0:
+        return
+      offset += sent
+      remaining -= sent
+
+
+def feed_clip_window(clip, fifo, reader_process):
+  try:
+    with open(clip['yuv_file'], 'rb') as source:
+      with open_fifo_for_writing(fifo, reader_process) as sink:
+        send_clip_window(clip, source, sink)
+  except OSError:
+    # The reader exited early, which is reported through its exit status.
+    pass
+
+
+def reference_window_file(clip):
+  key = result_cache.cache_key([clip['sha1sum'], clip['frame_offset'], clip['num_frames']])
+  return os.path.join(reference_window_dir, '%s.%d_%d.yuv' % (key, clip['width'], clip['height']))
+
+
+def reference_window(clip):
+  # Raw copy of the clip window, written once and shared by all metrics tools
+  # that read this window for the rest of the run.
+  window_file = reference_window_file(clip)
+  with reference_window_lock:
+    lock = reference_window_locks.setdefault(window_file, threading.Lock())
+  with lock:
+    if not os.path.isfile(window_file):
+      (fd, temp_file) = tempfile.mkstemp(dir=reference_window_dir, suffix='.tmp')
+      with os.fdopen(fd, 'wb') as sink:
+        with open(clip['yuv_file'], 'rb') as source:
+          send_clip_window(clip, source, sink)
+      os.replace(temp_file, window_file)
+  return window_file
+
+
+def start_clip_window_feed(clip, fifo, reader_process):
+  return start_daemon(lambda: feed_clip_window(clip, fifo, reader_process))
+
+
+def clip_input_file(job, temp_dir):
+  # Encoders read partial clip windows and .y4m clips through a FIFO that is fed
+  # from the original file once the encoder has started (see encode_once).
+  clip = job['clip']
+  if not clip_needs_feed(clip):
+    return clip['yuv_file']
+  job['input_fifo'] = make_fifo(temp_dir, '.%d_%d.yuv' % (clip['width'], clip['height']))
+  return job['input_fifo']
+
+
+def add_resource_usage(results_dict, stage, wall_time, user_time, sys_time, block_input, block_output, max_rss_kb=None):
+  # Per-stage resource usage, accumulated over all processes run by the stage.
+  def add(key, value):
+    results_dict[key] = results_dict.get(key, 0) + value
+  add('%s-wall-time-ms' % stage, wall_time * 1000)
+  add('%s-user-time-ms' % stage, user_time * 1000)
+  add('%s-sys-time-ms' % stage, sys_time * 1000)
+  add('%s-block-input-ops' % stage, block_input)
+  add('%s-block-output-ops' % stage, block_output)
+  if max_rss_kb is not None:
+    key = '%s-max-rss-kb' % stage
+    results_dict[key] = max(results_dict.get(key, 0), max_rss_kb)
+
+
+def wait_for_process(process, results_dict, stage, start_time):
+  # Like Popen.communicate() for processes with at most stdout piped, but reaps
+  # the process with os.wait4() to record its resource usage under |stage|.
+  output = None
+  if process.stdout:
+    output = process.stdout.read()
+    process.stdout.close()
+  (_, status, rusage) = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  add_resource_usage(results_dict, stage, time.monotonic() - start_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_inblock, rusage.ru_oublock, rusage.ru_maxrss)
+  return output
+
+
+class ThreadResourceUsage(object):
+  # Resource usage of in-process work done by the calling thread.
+  def __init__(self, results_dict, stage):
+    self.results_dict = results_dict
+    self.stage = stage
+
+  def __enter__(self):
+    self.start_time = time.monotonic()
+    self.start_usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return self
+
+  def __exit__(self, *exc_info):
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    add_resource_usage(self.results_dict, self.stage, time.monotonic() - self.start_time, usage.ru_utime - self.start_usage.ru_utime, usage.ru_stime - self.start_usage.ru_stime, usage.ru_inblock - self.start_usage.ru_inblock, usage.ru_oublock - self.start_usage.ru_oublock)
+
+
+def start_with_reference(clip, make_command, reads_y4m=False, **kwargs):
+  # Starts the command returned by |make_command(reference_file)|, where
+  # reference_file holds the clip window. Metrics tools may seek in their
+  # reference (tiny_ssim rewinds after checking for a .y4m header), so partial
+  # windows, and .y4m clips for tools that only read raw I420, are read from a
+  # shared copy rather than streamed through a FIFO like encoder input.
+  if not clip_window_is_partial(clip) and (reads_y4m or clip['file_type'] != 'y4m'):
+    return subprocess.Popen(make_command(clip['yuv_file']), **kwargs)
+  return subprocess.Popen(make_command(reference_window(clip)), **kwargs)
+
+
+def check_output_with_reference(clip, make_command, results_dict, stage, reads_y4m=False, **kwargs):
+  start_time = time.monotonic()
+  process = start_with_reference(clip, make_command, reads_y4m, stdout=subprocess.PIPE, **kwargs)
+  output = wait_for_process(process, results_dict, stage, start_time)
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, process.args, output)
+  return output
+
+
+def decoder_command(job, encoded_file, decoded_file, framestats_file, spatial_layer=0):
+  if job['codec'] in ['av1', 'vp8', 'vp9']:
+    decoder = 'aom/aomdec' if job['codec'] == 'av1' else 'libvpx/vpxdec'
+    command = [decoder, '--i420', '--codec=%s' % job['codec'], '-o', decoded_file, encoded_file, '--framestats=%s' % framestats_file]
+    if job['num_spatial_layers'] > 1:
+      command.append('--svc-decode-layer=%d' % spatial_layer)
+    return command
+  elif job['codec'] == 'h264':
+    return ['openh264/h264dec', encoded_file, decoded_file]
+
+
+def decoder_framestats_file(job, temp_dir):
+  # TODO(pbos): Generate H264 framestats.
+  if job['codec'] == 'h264':
+    return None
   (fd, framestats_file) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
   os.close(fd)
+  return framestats_file
+
+
+def decode_file(results_dict, job, temp_dir, encoded_file):
+  (fd, decoded_file) = tempfile.mkstemp(dir=temp_dir, suffix=".yuv")
+  os.close(fd)
+  framestats_file = decoder_framestats_file(job, temp_dir)
+  command = decoder_command(job, encoded_file['filename'], decoded_file, framestats_file, encoded_file['spatial-layer'])
   with open(os.devnull, 'w') as devnull:
-    if job['codec'] in ['av1', 'vp8', 'vp9']:
-      decoder = 'aom/aomdec' if job['codec'] == 'av1' else 'libvpx/vpxdec'
-      subprocess.check_call([decoder, '--i420', '--codec=%s' % job['codec'], '-o', decoded_file, encoded_file, '--framestats=%s' % framestats_file], stdout=devnull, stderr=devnull)
-    elif job['codec'] == 'h264':
-      subprocess.check_call(['openh264/h264dec', encoded_file, decoded_file], stdout=devnull, stderr=devnull)
-      # TODO(pbos): Generate H264 framestats.
-      framestats_file = None
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+    wait_for_process(process, results_dict, 'decode', start_time)
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command)
+  # Metrics would silently compare misaligned frames if the decoder output
+  # doesn't have the size the layer is measured at.
+  (width, height) = scaled_size(job['clip'], spatial_divide(job, encoded_file))
+  if os.path.getsize(decoded_file) % y4m.i420_frame_size(width, height) != 0:
+    raise ValueError("'%s' doesn't decode to whole %dx%d frames." % (encoded_file['filename'], width, height))
   return (decoded_file, framestats_file)
 
 
+def vmaf_command(reference, reference_file, decoded_file):
+  return ['vmaf/run_vmaf', 'yuv420p', str(reference['width']), str(reference['height']), reference_file, decoded_file, '--out-fmt', 'json']
+
+
+def add_vmaf_results(results_dict, vmaf_results):
+  vmaf_obj = json.loads(vmaf_results)
+  results_dict['vmaf'] = float(vmaf_obj['aggregate']['VMAF_score'])
+
+  results_dict['frame-vmaf'] = []
+  for frame in vmaf_obj['frames']:
+    results_dict['frame-vmaf'].append(frame['VMAF_score'])
+
+
+def stream_decode_metrics(results_dict, job, temp_dir, encoded_file, temporal_skip):
+  # Decodes into a pipe that is consumed frame by frame by the metrics engine,
+  # so no decoded .yuv file is written. VMAF, if enabled, reads decoded frames
+  # through a FIFO fed from the same stream.
+  clip = layer_reference(job, encoded_file)
+  framestats_file = decoder_framestats_file(job, temp_dir)
+  (read_fd, write_fd) = os.pipe()
+  vmaf_process = None
+  sinks = []
+  with open(os.devnull, 'w') as devnull:
+    start_time = time.monotonic()
+    try:
+      decoder = subprocess.Popen(decoder_command(job, encoded_file['filename'], '/dev/fd/%d' % write_fd, framestats_file, encoded_file['spatial-layer']), stdout=devnull, stderr=devnull, pass_fds=(write_fd,))
+    finally:
+      os.close(write_fd)
+    try:
+      with os.fdopen(read_fd, 'rb') as stream:
+        try:
+          if args.enable_vmaf:
+            vmaf_fifo = os.path.join(temp_dir, 'vmaf-%d-%d.yuv' % (encoded_file['spatial-layer'], encoded_file['temporal-layer']))
+            os.mkfifo(vmaf_fifo)
+            vmaf_start_time = time.monotonic()
+            vmaf_process = start_with_reference(clip, lambda reference_file: vmaf_command(clip, reference_file, vmaf_fifo), stdout=subprocess.PIPE, stderr=devnull)
+            sinks.append(open_fifo_for_writing(vmaf_fifo, vmaf_process))
+          with ThreadResourceUsage(results_dict, 'metrics'):
+            results_dict.update(yuv_metrics.stream_metrics(clip['yuv_file'], stream, clip['width'], clip['height'], temporal_skip, clip['frame_offset'], clip['num_frames'], sinks))
+        finally:
+          for sink in sinks:
+            sink.close()
+    finally:
+      # Closing the pipe and FIFO above ends the decoder and VMAF early if
+      # metrics failed, both are reaped either way.
+      wait_for_process(decoder, results_dict, 'decode', start_time)
+      if vmaf_process:
+        vmaf_results = wait_for_process(vmaf_process, results_dict, 'vmaf', vmaf_start_time)
+    if decoder.returncode != 0:
+      raise subprocess.CalledProcessError(decoder.returncode, decoder.args)
+  if vmaf_process:
+    if vmaf_process.returncode != 0:
+      raise subprocess.CalledProcessError(vmaf_process.returncode, vmaf_process.args)
+    add_vmaf_results(results_dict, vmaf_results)
+  return framestats_file
+
+
 def add_framestats(results_dict, framestats_file, statstype):
   with open(framestats_file) as csvfile:
     reader = csv.DictReader(csvfile)
@@ -391,15 +825,10 @@ def add_framestats(results_dict, framestats_file, statstype):
         results_dict[metric_key].append(statstype(value))
 
 
-def generate_metrics(results_dict, job, temp_dir, encoded_file):
-  (decoded_file, decoder_framestats) = decode_file(job, temp_dir, encoded_file['filename'])
-  clip = job['clip']
-  temporal_divide = 2 ** (job['num_temporal_layers'] - 1 - encoded_file['temporal-layer'])
-  temporal_skip = temporal_divide - 1
-  # TODO(pbos): Perform SSIM on downscaled .yuv files for spatial layers.
+def run_tiny_ssim(results_dict, clip, temp_dir, decoded_file, temporal_skip):
   (fd, metrics_framestats) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
   os.close(fd)
-  ssim_results = subprocess.check_output(['libvpx/tools/tiny_ssim', clip['yuv_file'], decoded_file, "%dx%d" % (results_dict['width'], results_dict['height']), str(temporal_skip), metrics_framestats]).splitlines()
+  ssim_results = check_output_with_reference(clip, lambda reference_file: ['libvpx/tools/tiny_ssim', reference_file, decoded_file, "%dx%d" % (clip['width'], clip['height']), str(temporal_skip), metrics_framestats], results_dict, 'metrics', reads_y4m=True, universal_newlines=True).splitlines()
   metric_map = {
     'AvgPSNR': 'avg-psnr',
     'AvgPSNR-Y': 'avg-psnr-y',
@@ -422,82 +851,395 @@ def generate_metrics(results_dict, job, temp_dir, encoded_file):
     if metric in metric_map:
       results_dict[metric_map[metric]] = float(value)
     elif metric == 'Nframes':
-      layer_frames = int(value)
-      results_dict['frame-count'] = layer_frames
+      results_dict['frame-count'] = int(value)
 
-  if decoder_framestats:
-    add_framestats(results_dict, decoder_framestats, int)
   add_framestats(results_dict, metrics_framestats, float)
 
+
+def temporal_divide(job, encoded_file):
+  return 2 ** (job['num_temporal_layers'] - 1 - encoded_file['temporal-layer'])
+
+
+def spatial_divide(job, encoded_file):
+  return 2 ** (job['num_spatial_layers'] - 1 - encoded_file['spatial-layer'])
+
+
+def scaled_size(clip, divide):
+  # Same as vp9_get_layer_resolution() in libvpx: dimensions are divided
+  # rounding down, then rounded up to an even number.
+  def scale(dim):
+    dim //= divide
+    return dim + dim % 2
+  return (scale(clip['width']), scale(clip['height']))
+
+
+def layer_index(job, encoded_file):
+  # Index into job['target_bitrates_kbps']. Jobs have either multiple spatial or
+  # multiple temporal layers, not both.
+  return encoded_file['spatial-layer'] * job['num_temporal_layers'] + encoded_file['temporal-layer']
+
+
+def scaled_reference_file(clip, width, height):
+  key = result_cache.cache_key([clip['sha1sum'], clip['frame_offset'], clip['num_frames'], clip['width'], clip['height'], width, height, yuv_metrics.SCALER_VERSION])
+  return os.path.join(args.scaled_reference_dir, '%s.%d_%d.yuv' % (key, width, height))
+
+
+def scaled_reference(clip, width, height):
+  # Downscaled copy of the clip window, written once and shared by all jobs that
+  # measure spatial layers of this size.
+  scaled_file = scaled_reference_file(clip, width, height)
+  with scaled_reference_lock:
+    lock = scaled_reference_locks.setdefault(scaled_file, threading.Lock())
+  with lock:
+    if not os.path.isfile(scaled_file):
+      (fd, temp_file) = tempfile.mkstemp(dir=args.scaled_reference_dir, suffix='.tmp')
+      os.close(fd)
+      yuv_metrics.write_scaled_frames(clip['yuv_file'], clip['width'], clip['height'], clip['frame_offset'], clip['num_frames'], temp_file, width, height)
+      os.replace(temp_file, scaled_file)
+  return scaled_file
+
+
+def layer_reference(job, encoded_file):
+  # Clip window that a layer is measured against, downscaled for lower spatial
+  # layers.
+  clip = job['clip']
+  divide = spatial_divide(job, encoded_file)
+  if divide == 1:
+    return clip
+  reference = dict(clip)
+  (reference['width'], reference['height']) = scaled_size(clip, divide)
+  reference['yuv_file'] = scaled_reference(clip, reference['width'], reference['height'])
+  reference['file_type'] = 'yuv'
+  reference['frame_offset'] = 0
+  reference['input_total_frames'] = clip['num_frames']
+  return reference
+
+
+def decode_layer(results_dict, job, temp_dir, encoded_file):
+  # With --stream-decode, decoding happens as part of measure_layer().
+  if args.stream_decode:
+    return None
+  return decode_file(results_dict, job, temp_dir, encoded_file)
+
+
+def run_vmaf(clip, decoded_file):
+  # Returns VMAF results in a separate dict, so that VMAF can run alongside
+  # other metrics that update the layer's results.
+  vmaf_results = {}
+  output = check_output_with_reference(clip, lambda reference_file: vmaf_command(clip, reference_file, decoded_file), vmaf_results, 'vmaf')
+  add_vmaf_results(vmaf_results, output)
+  return vmaf_results
+
+
+def measure_layer(results_dict, job, temp_dir, encoded_file, decoded):
+  temporal_skip = temporal_divide(job, encoded_file) - 1
+  if decoded is None:
+    decoder_framestats = stream_decode_metrics(results_dict, job, temp_dir, encoded_file, temporal_skip)
+  else:
+    (decoded_file, decoder_framestats) = decoded
+    clip = layer_reference(job, encoded_file)
+    # VMAF is much slower than PSNR/SSIM, so it runs concurrently with them on
+    # the same decoded file rather than after them.
+    vmaf_future = None
+    if args.enable_vmaf:
+      vmaf_future = metrics_backend_executor.submit(run_vmaf, clip, decoded_file)
+    try:
+      if args.metrics_engine == 'numpy':
+        with ThreadResourceUsage(results_dict, 'metrics'):
+          results_dict.update(yuv_metrics.compute_metrics(clip['yuv_file'], decoded_file, clip['width'], clip['height'], temporal_skip, clip['frame_offset'], clip['num_frames']))
+      else:
+        run_tiny_ssim(results_dict, clip, temp_dir, decoded_file, temporal_skip)
+    finally:
+      # Wait for VMAF even if other metrics failed, it's still reading the
+      # decoded file.
+      if vmaf_future:
+        concurrent.futures.wait([vmaf_future])
+    if vmaf_future:
+      results_dict.update(vmaf_future.result())
+    os.remove(decoded_file)
+  add_layer_results(results_dict, job, encoded_file, decoder_framestats)
+
+
+def measure_layers(results, job, temp_dir, encoded_files, decoded_layers):
+  # Measures all decoded layers of a job with --metrics-engine=numpy in a single
+  # pass over the reference, instead of reading it once per layer.
+  clip = job['clip']
+  vmaf_futures = []
   if args.enable_vmaf:
-    vmaf_results = subprocess.check_output(['vmaf/run_vmaf', 'yuv420p', str(results_dict['width']), str(results_dict['height']), clip['yuv_file'], decoded_file, '--out-fmt', 'json'])
-    vmaf_obj = json.loads(vmaf_results)
-    results_dict['vmaf'] = float(vmaf_obj['aggregate']['VMAF_score'])
+    vmaf_futures = [metrics_backend_executor.submit(run_vmaf, clip, decoded_file) for (results_dict, (decoded_file, _)) in zip(results, decoded_layers)]
+  try:
+    usage = {}
+    with ThreadResourceUsage(usage, 'metrics'):
+      layer_metrics = yuv_metrics.compute_layer_metrics(clip['yuv_file'], [(decoded_file, temporal_divide(job, layer) - 1) for (layer, (decoded_file, _)) in zip(encoded_files, decoded_layers)], clip['width'], clip['height'], clip['frame_offset'], clip['num_frames'])
+  finally:
+    concurrent.futures.wait(vmaf_futures)
+  for (i, results_dict) in enumerate(results):
+    results_dict.update(layer_metrics[i])
+    # The pass is shared, so its cost is split evenly between layers.
+    for (key, value) in usage.items():
+      results_dict[key] = results_dict.get(key, 0) + value / len(results)
+    if vmaf_futures:
+      results_dict.update(vmaf_futures[i].result())
+  for (results_dict, layer, (decoded_file, decoder_framestats)) in zip(results, encoded_files, decoded_layers):
+    os.remove(decoded_file)
+    add_layer_results(results_dict, job, layer, decoder_framestats)
+
+
+def add_layer_results(results_dict, job, encoded_file, decoder_framestats):
+  clip = job['clip']
+  layer_frames = results_dict['frame-count']
 
-    results_dict['frame-vmaf'] = []
-    for frame in vmaf_obj['frames']:
-      results_dict['frame-vmaf'].append(frame['VMAF_score'])
+  if decoder_framestats:
+    add_framestats(results_dict, decoder_framestats, int)
 
-  layer_fps = clip['fps'] / temporal_divide
+  layer_fps = clip['fps'] / temporal_divide(job, encoded_file)
   results_dict['layer-fps'] = layer_fps
 
-  spatial_divide = 2 ** (job['num_spatial_layers'] - 1 - encoded_file['spatial-layer'])
-  results_dict['layer-width'] = results_dict['width'] // spatial_divide
-  results_dict['layer-height'] = results_dict['height'] // spatial_divide
+  (results_dict['layer-width'], results_dict['layer-height']) = scaled_size(job['clip'], spatial_divide(job, encoded_file))
 
-  target_bitrate_bps = job['target_bitrates_kbps'][encoded_file['temporal-layer']] * 1000
-  bitrate_used_bps = os.path.getsize(encoded_file['filename']) * 8 * layer_fps / layer_frames
+  target_bitrate_bps = job['target_bitrates_kbps'][layer_index(job, encoded_file)] * 1000
+  container_bitrate_bps = os.path.getsize(encoded_file['filename']) * 8 * layer_fps / layer_frames
+  results_dict['container-bitrate-bps'] = container_bitrate_bps
+  bitrate_used_bps = container_bitrate_bps
+  # Frame sizes parsed from the encoded file exclude container overhead, and
+  # are also available for codecs whose decoder doesn't write framestats.
+  try:
+    frames = bitstream.read_frames(encoded_file['filename'], encoded_file['spatial-layer'] if job['num_spatial_layers'] > 1 else None)
+  except ValueError as e:
+    print("WARNING: Using file size for bitrate of '%s': %s" % (encoded_file['filename'], e))
+    frames = None
+  if frames:
+    bitrate_used_bps = sum(size for (_, size, _) in frames) * 8 * layer_fps / layer_frames
+    # Only used per frame when packets map 1:1 to decoded frames.
+    if len(frames) == layer_frames:
+      results_dict['frame-bytes'] = [size for (_, size, _) in frames]
+      results_dict['frame-keyframe'] = [int(keyframe) for (_, _, keyframe) in frames]
   results_dict['target-bitrate-bps'] = target_bitrate_bps
   results_dict['actual-bitrate-bps'] = bitrate_used_bps
   results_dict['bitrate-utilization'] = float(bitrate_used_bps) / target_bitrate_bps
 
 
-def run_command(job, xxx_todo_changeme, job_temp_dir, encoded_file_dir):
-  (command, encoded_files) = xxx_todo_changeme
+def generate_metrics(results_dict, job, temp_dir, encoded_file):
+  measure_layer(results_dict, job, temp_dir, encoded_file, decode_layer(results_dict, job, temp_dir, encoded_file))
+
+
+def encoded_file_name(job, layer):
+  clip = job['clip']
+  return "%s-%s-%s-%dsl%dtl-%d-sl%d-tl%d%s" % (os.path.splitext(os.path.basename(clip['input_file']))[0], job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], job['target_bitrates_kbps'][-1], layer['spatial-layer'], layer['temporal-layer'], os.path.splitext(layer['filename'])[1])
+
+
+# Bump when the results computed for a job change, which invalidates cached
+# results.
+RESULTS_VERSION = 2
+
+def job_cache_key(job, command, job_temp_dir):
+  # Everything that influences a job's results: clip contents and window, the
+  # encoder command line and the binaries used to encode, decode and measure.
+  # Temporary paths are normalized since they differ between runs.
+  clip = job['clip']
+  temp_path_pattern = re.compile(re.escape(job_temp_dir) + r'/[^\s,:=]*?(\.\w+)?$')
+  normalized_command = [binary_hash(command[0])]
+  for arg in command[1:]:
+    arg = arg.replace(clip['yuv_file'], '$CLIP')
+    normalized_command.append(temp_path_pattern.sub(lambda match: '$TMP%s' % (match.group(1) or ''), arg))
+  decoder = decoder_command(job, '', '', '')[0]
+  metrics_tools = []
+  if args.metrics_engine == 'tiny_ssim':
+    metrics_tools.append(binary_hash(find_absolute_path(False, 'libvpx/tools/tiny_ssim')))
+  if args.enable_vmaf:
+    metrics_tools.append(binary_hash(find_absolute_path(False, 'vmaf/run_vmaf')))
+  key = {
+    'clip-sha1sum': clip['sha1sum'],
+    'frame-offset': clip['frame_offset'],
+    'num-frames': clip['num_frames'],
+    'command': normalized_command,
+    'decoder': binary_hash(find_absolute_path(False, decoder)),
+    'metrics-engine': args.metrics_engine,
+    'metrics-tools': metrics_tools,
+    'results-version': RESULTS_VERSION,
+  }
+  # Lower spatial layers are measured against downscaled references.
+  if job['num_spatial_layers'] > 1:
+    key['scaler-version'] = yuv_metrics.SCALER_VERSION
+  # Encode times of cached results are only reused when measured alike.
+  if args.isolated_timing:
+    key['encode-timing'] = [args.timing_warmup_runs, args.timing_repetitions]
+  return result_cache.cache_key(key)
+
+
+def load_cached_results(cache_key, job, encoded_files, job_temp_dir, encoded_file_dir):
+  cached = job_result_cache.get(cache_key, need_files=encoded_file_dir is not None)
+  if cached is None:
+    return None
+  (results, cached_files) = cached
+  # Entries are keyed by clip contents, so they may have been stored for the
+  # same clip under another name.
+  for results_dict in results:
+    add_job_identity(results_dict, job)
+  if encoded_file_dir:
+    for (layer, cached_file) in zip(encoded_files, cached_files):
+      shutil.copyfile(cached_file, os.path.join(encoded_file_dir, encoded_file_name(job, layer)))
+  shutil.rmtree(job_temp_dir)
+  return results
+
+
+def start_pinned(command, cpus, **kwargs):
+  # Processes inherit the CPU affinity of the thread starting them, which is
+  # what sched_setaffinity() sets for pid 0.
+  if cpus is None:
+    return subprocess.Popen(command, **kwargs)
+  thread_cpus = os.sched_getaffinity(0)
+  os.sched_setaffinity(0, cpus)
+  try:
+    return subprocess.Popen(command, **kwargs)
+  finally:
+    os.sched_setaffinity(0, thread_cpus)
+
+
+def encode_once(job, command, encode_usage, cpus=None):
+  # Returns the encoder's exit code and output.
+  start_time = time.monotonic()
+  process = start_pinned(command, cpus, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  if 'input_fifo' in job:
+    feeder = start_clip_window_feed(job['clip'], job['input_fifo'], process)
+  output = wait_for_process(process, encode_usage, 'encode', start_time)
+  if 'input_fifo' in job:
+    feeder.join()
+  return (process.returncode, output)
+
+
+def encode_isolated(job, command):
+  # Runs the encoder pinned to CPUs of its own, once to warm up caches and then
+  # --timing-repetitions times. Usage of the last run is returned, along with
+  # timing statistics of all timed runs. Encoded files of the last run are
+  # kept.
   clip = job['clip']
-  start_time = time.time()
+  cpus = encoder_cpu_sets.claim(job_threads(job))
   try:
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    encode_times_ms = []
+    for i in range(args.timing_warmup_runs + args.timing_repetitions):
+      encode_usage = {}
+      (returncode, output) = encode_once(job, command, encode_usage, cpus)
+      if returncode != 0:
+        return (returncode, output, encode_usage)
+      if i >= args.timing_warmup_runs:
+        encode_times_ms.append(encode_usage['encode-wall-time-ms'])
+  finally:
+    encoder_cpu_sets.release(cpus)
+  encode_fps = [clip['num_frames'] * 1000 / ms for ms in encode_times_ms]
+  encode_usage['encode-pinned-cpus'] = len(cpus)
+  encode_usage['encode-time-ms-runs'] = encode_times_ms
+  encode_usage['encode-time-ms-median'] = statistics.median(encode_times_ms)
+  encode_usage['encode-fps-median'] = statistics.median(encode_fps)
+  if len(encode_times_ms) > 1:
+    encode_usage['encode-time-ms-stdev'] = statistics.stdev(encode_times_ms)
+    encode_usage['encode-fps-stdev'] = statistics.stdev(encode_fps)
+  return (returncode, output, encode_usage)
+
+
+def add_job_identity(results_dict, job):
+  # Fields describing the job rather than its results.
+  clip = job['clip']
+  results_dict['input-file'] = os.path.basename(clip['input_file'])
+  results_dict['input-file-sha1sum'] = clip['sha1sum']
+  results_dict['input-total-frames'] = clip['input_total_frames']
+  results_dict['frame-offset'] = clip['frame_offset']
+  results_dict['num-frames'] = clip['num_frames']
+  results_dict['bitrate-config-kbps'] = job['target_bitrates_kbps']
+  results_dict['layer-pattern'] = "%dsl%dtl" % (job['num_spatial_layers'], job['num_temporal_layers'])
+  results_dict['encoder'] = job['encoder']
+  results_dict['codec'] = job['codec']
+  results_dict['height'] = clip['height']
+  results_dict['width'] = clip['width']
+  results_dict['fps'] = clip['fps']
+
+
+def run_encoder(job, command, encoded_files):
+  # Returns (results, output), where results holds a partially filled results
+  # dict per encoded layer, or None if encoding failed.
+  clip = job['clip']
+  encode_usage = {}
+  try:
+    if args.isolated_timing:
+      (returncode, output, encode_usage) = encode_isolated(job, command)
+    else:
+      (returncode, output) = encode_once(job, command, encode_usage)
   except OSError as e:
     return (None, "> %s\n%s" % (" ".join(command), e))
-  (output, _) = process.communicate()
-  actual_encode_ms = (time.time() - start_time) * 1000
-  input_yuv_filesize = os.path.getsize(clip['yuv_file'])
-  input_num_frames = int(input_yuv_filesize / (6 * clip['width'] * clip['height'] / 4))
-  target_encode_ms = float(input_num_frames) * 1000 / clip['fps']
-  if process.returncode != 0:
+  # Isolated timing reports the median over all timed runs.
+  actual_encode_ms = encode_usage.get('encode-time-ms-median', encode_usage['encode-wall-time-ms'])
+  target_encode_ms = float(clip['num_frames']) * 1000 / clip['fps']
+  if returncode != 0:
     return (None, "> %s\n%s" % (" ".join(command), output))
   results = [{} for i in range(len(encoded_files))]
   for i in range(len(results)):
     results_dict = results[i]
-    results_dict['input-file'] = os.path.basename(clip['input_file'])
-    results_dict['input-file-sha1sum'] = clip['sha1sum']
-    results_dict['input-total-frames'] = clip['input_total_frames']
-    results_dict['frame-offset'] = args.frame_offset
-    results_dict['bitrate-config-kbps'] = job['target_bitrates_kbps']
-    results_dict['layer-pattern'] = "%dsl%dtl" % (job['num_spatial_layers'], job['num_temporal_layers'])
-    results_dict['encoder'] = job['encoder']
-    results_dict['codec'] = job['codec']
-    results_dict['height'] = clip['height']
-    results_dict['width'] = clip['width']
-    results_dict['fps'] = clip['fps']
+    add_job_identity(results_dict, job)
     results_dict['actual-encode-time-ms'] = actual_encode_ms
     results_dict['target-encode-time-ms'] = target_encode_ms
     results_dict['encode-time-utilization'] = actual_encode_ms / target_encode_ms
+    results_dict.update(encode_usage)
+    results_dict['encode-cpu-time-ms-per-frame'] = (encode_usage['encode-user-time-ms'] + encode_usage['encode-sys-time-ms']) / clip['num_frames']
     layer = encoded_files[i]
 
     results_dict['temporal-layer'] = layer['temporal-layer']
     results_dict['spatial-layer'] = layer['spatial-layer']
+  return (results, output)
 
-    generate_metrics(results_dict, job, job_temp_dir, layer)
+
+def finish_job(job, results, encoded_files, job_temp_dir, encoded_file_dir, cache_key):
+  if cache_key:
+    job_result_cache.put(cache_key, results, [layer['filename'] for layer in encoded_files] if args.cache_encoded_files else [])
+
+  for (i, layer) in enumerate(encoded_files):
+    # Spatial layers share a file, which is only moved or removed for its last
+    # layer.
+    last_use = layer['filename'] not in [later['filename'] for later in encoded_files[i + 1:]]
     if encoded_file_dir:
-      encoded_file_pattern = "%s-%s-%s-%dsl%dtl-%d-sl%d-tl%d%s" % (os.path.splitext(os.path.basename(clip['input_file']))[0], job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], job['target_bitrates_kbps'][-1], layer['spatial-layer'], layer['temporal-layer'], os.path.splitext(layer['filename'])[1])
-      shutil.move(layer['filename'], os.path.join(encoded_file_dir, encoded_file_pattern))
-    else:
+      (shutil.move if last_use else shutil.copyfile)(layer['filename'], os.path.join(encoded_file_dir, encoded_file_name(job, layer)))
+    elif last_use:
       os.remove(layer['filename'])
 
   shutil.rmtree(job_temp_dir)
 
+
+def measure_jointly(job, encoded_files):
+  # Spatial layers are measured against differently scaled references.
+  return args.metrics_engine == 'numpy' and not args.stream_decode and len(encoded_files) > 1 and job['num_spatial_layers'] == 1
+
+
+def generate_job_metrics(executor, results, job, temp_dir, encoded_files):
+  # Measures all layers of a job concurrently on |executor|. This must not be
+  # metrics_backend_executor, which layers themselves submit work to.
+  if measure_jointly(job, encoded_files):
+    decoded_layers = list(executor.map(decode_layer, results, [job] * len(results), [temp_dir] * len(results), encoded_files))
+    measure_layers(results, job, temp_dir, encoded_files, decoded_layers)
+    return
+  futures = [executor.submit(generate_metrics, results_dict, job, temp_dir, layer) for (results_dict, layer) in zip(results, encoded_files)]
+  concurrent.futures.wait(futures)
+  for future in futures:
+    future.result()
+
+
+def run_command(job, xxx_todo_changeme, job_temp_dir, encoded_file_dir, cache_key=None, layer_executor=None):
+  # Runs all stages of a job, measuring its layers concurrently on
+  # |layer_executor| (or a pool of its own). main() instead runs jobs through a
+  # pipeline of encode, decode and metrics stages (see worker()).
+  (command, encoded_files) = xxx_todo_changeme
+  (results, output) = run_encoder(job, command, encoded_files)
+  if results is None:
+    shutil.rmtree(job_temp_dir, ignore_errors=True)
+    return (None, output)
+  try:
+    if layer_executor:
+      generate_job_metrics(layer_executor, results, job, job_temp_dir, encoded_files)
+    else:
+      with concurrent.futures.ThreadPoolExecutor(len(encoded_files)) as executor:
+        generate_job_metrics(executor, results, job, job_temp_dir, encoded_files)
+  except Exception:
+    shutil.rmtree(job_temp_dir, ignore_errors=True)
+    raise
+  finish_job(job, results, encoded_files, job_temp_dir, encoded_file_dir, cache_key)
   return (results, output)
 
 
@@ -531,26 +1273,232 @@ def split_temporal_bitrates_kbps(target_bitrate_kbps, num_temporal_layers):
   return bitrates_kbps
 
 
-def generate_jobs(args, temp_dir):
+def make_job(args, clip, encoder, codec, bitrate_kbps):
+  job = {
+    'encoder': encoder,
+    'codec': codec,
+    'clip': clip,
+    # Spatial layers split bitrates the same way as temporal layers.
+    'target_bitrates_kbps': split_temporal_bitrates_kbps(bitrate_kbps, args.num_spatial_layers * args.num_temporal_layers),
+    'num_spatial_layers': args.num_spatial_layers,
+    'num_temporal_layers': args.num_temporal_layers,
+  }
+  return job
+
+
+def job_command(job, job_temp_dir):
+  # Encoder commands write to the job's temp dir, so they're only built once
+  # the job is about to run.
+  (command, encoded_files) = encoder_commands[job['encoder']](job, job_temp_dir)
+  command[0] = find_absolute_path(args.use_system_path, command[0])
+  return (command, encoded_files)
+
+
+# Room for container overhead and encoder logs in job temp dirs.
+SCRATCH_OVERHEAD_BYTES = 1024 * 1024
+def job_scratch_bytes(job):
+  # Peak size of a job's temp dir: its encoded files, allowing for twice the
+  # target bitrate, and unless decoding is streamed a decoded .yuv file per
+  # layer, which may all exist at once. Downscaled references and clip windows
+  # read by metrics tools are shared between jobs, see job_shared_files().
+  clip = job['clip']
+  size = 2 * job['target_bitrates_kbps'][-1] * 1000 / 8 * clip['num_frames'] / clip['fps'] + SCRATCH_OVERHEAD_BYTES
+  if not args.stream_decode:
+    for spatial_layer in range(job['num_spatial_layers']):
+      divide = 2 ** (job['num_spatial_layers'] - 1 - spatial_layer)
+      for temporal_layer in range(job['num_temporal_layers']):
+        layer_frames = -(-clip['num_frames'] // 2 ** (job['num_temporal_layers'] - 1 - temporal_layer))
+        size += layer_frames * y4m.i420_frame_size(*scaled_size(clip, divide))
+  return int(size)
+
+
+def job_shared_files(job):
+  # (file, size) of files shared between jobs that a job may create in the
+  # scratch directory on disk: copies of the clip window read by metrics tools
+  # (see start_with_reference), and downscaled references of lower spatial
+  # layers unless they're kept in a --scaled-reference-dir of their own.
+  clip = job['clip']
+  shared_files = []
+  tiny_ssim_copy = args.metrics_engine == 'tiny_ssim' and clip_window_is_partial(clip)
+  vmaf_copy = args.enable_vmaf and clip_needs_feed(clip)
+  if tiny_ssim_copy or vmaf_copy:
+    shared_files.append((reference_window_file(clip), clip['num_frames'] * y4m.i420_frame_size(clip['width'], clip['height'])))
+  scratch_dir = os.path.abspath(job_scratch.directories[-1])
+  if os.path.commonpath([scratch_dir, os.path.abspath(args.scaled_reference_dir)]) == scratch_dir:
+    for spatial_layer in range(job['num_spatial_layers'] - 1):
+      (width, height) = scaled_size(clip, 2 ** (job['num_spatial_layers'] - 1 - spatial_layer))
+      shared_files.append((scaled_reference_file(clip, width, height), clip['num_frames'] * y4m.i420_frame_size(width, height)))
+  return shared_files
+
+
+def scheduled_job(job):
+  return (job_cost_model.estimate(job_preset(job), job_work(job)), job_threads(job), job_scratch_bytes(job), job_shared_files(job), job)
+
+
+def preview_clips(clip, num_segments, segment_frames):
+  # Clips restricted to the segments sampled from |clip|, with their weights.
+  activity = yuv_metrics.temporal_activity(clip['yuv_file'], clip['width'], clip['height'], clip['frame_offset'], clip['num_frames'])
+  segment_clips = []
+  for (first_frame, num_frames, weight) in preview.select_segments(list(activity), num_segments, segment_frames):
+    segment_clip = dict(clip)
+    segment_clip['frame_offset'] = clip['frame_offset'] + first_frame
+    segment_clip['num_frames'] = num_frames
+    segment_clips.append((segment_clip, weight))
+  return segment_clips
+
+
+def generate_jobs(args):
   jobs = []
   for clip in args.clips:
     bitrates = find_bitrates(clip['width'], clip['height'])
+    if args.preview_segments:
+      # Each segment is a job of its own. Their results are combined once all
+      # segments encoded at the same settings are done.
+      segment_clips = preview_clips(clip, args.preview_segments, args.preview_segment_frames)
+      segments = [(segment_clip['frame_offset'], segment_clip['num_frames']) for (segment_clip, _) in segment_clips]
+      weights = [weight for (_, weight) in segment_clips]
+      for bitrate_kbps in bitrates:
+        for (encoder, codec) in args.encoders:
+          group = preview.SegmentGroup(clip['frame_offset'], segments, weights, quality_metrics)
+          for (i, (segment_clip, _)) in enumerate(segment_clips):
+            job = make_job(args, segment_clip, encoder, codec, bitrate_kbps)
+            job['preview'] = (group, i)
+            jobs.append(job)
+      continue
+    if args.target_quality:
+      # Each clip and encoder starts out with a single job in the middle of the
+      # bitrate range, later jobs are added as the search progresses.
+      for (encoder, codec) in args.encoders:
+        search = bitrate_search.BitrateSearch(args.target_quality, math.sqrt(bitrates[0] * bitrates[-1]), bitrates[0] / 4, bitrates[-1] * 4, args.search_tolerance, args.search_max_encodes)
+        bitrate_searches.append((clip, encoder, codec, search))
+        job = make_job(args, clip, encoder, codec, search.next_bitrate())
+        job['search'] = search
+        jobs.append(job)
+      continue
     for bitrate_kbps in bitrates:
       for (encoder, codec) in args.encoders:
-        job = {
+        jobs.append(make_job(args, clip, encoder, codec, bitrate_kbps))
+  return jobs
+
+
+def continue_search(job, results):
+  # Feeds the quality of the job's top layer back into its search, and queues
+  # the next bitrate to encode, if any. Each search has a scheduler hold for as
+  # long as it has a job queued or running.
+  global total_jobs
+  search = job['search']
+  quality = None
+  if results:
+    quality = max(results, key=lambda result: (result['spatial-layer'], result['temporal-layer']))
+  search.add_point(job['target_bitrates_kbps'][-1], quality)
+  bitrate_kbps = search.next_bitrate()
+  if bitrate_kbps is None:
+    job_scheduler.release()
+    return
+  next_job = make_job(args, job['clip'], job['encoder'], job['codec'], bitrate_kbps)
+  next_job['search'] = search
+  with thread_lock:
+    total_jobs += 1
+  job_scheduler.add(scheduled_job(next_job))
+
+
+def finish_preview_segment(job, results):
+  (group, i) = job['preview']
+  if not group.add(i, results):
+    return
+  global has_errored
+  aggregated = group.aggregate()
+  with thread_lock:
+    if aggregated is None:
+      has_errored = True
+      print("Not all preview segments of %s succeeded, skipping its results." % job_to_string(job))
+      return
+    for result in aggregated:
+      result_writer.write(result)
+
+
+def write_search_results(out):
+  for (clip, encoder, codec, search) in bitrate_searches:
+    for answer in search.answers:
+      bitrate = '%.0f kbps' % answer['bitrate-kbps'] if answer['bitrate-kbps'] is not None else 'not reached'
+      print("%s:%s %s %s=%g: %s (%d encodes)" % (encoder, codec, os.path.basename(clip['input_file']), answer['metric'], answer['target'], bitrate, answer['encodes']))
+      if out:
+        entry = {
+          'input-file': os.path.basename(clip['input_file']),
+          'input-file-sha1sum': clip['sha1sum'],
           'encoder': encoder,
           'codec': codec,
-          'clip': clip,
-          'target_bitrates_kbps': split_temporal_bitrates_kbps(bitrate_kbps, args.num_temporal_layers),
-          'num_spatial_layers': args.num_spatial_layers,
-          'num_temporal_layers': args.num_temporal_layers,
+          'layer-pattern': "%dsl%dtl" % (args.num_spatial_layers, args.num_temporal_layers),
         }
-        job_temp_dir = tempfile.mkdtemp(dir=temp_dir)
-        (command, encoded_files) = encoder_commands[job['encoder']](job, job_temp_dir)
-        command[0] = find_absolute_path(args.use_system_path, command[0])
-        jobs.append((job, (command, encoded_files), job_temp_dir))
+        entry.update(answer)
+        out.write(json.dumps(entry, sort_keys=True) + '\n')
+  if out:
+    out.close()
+
+def job_id(job):
+  # Stable across hosts and runs, as it only depends on clip contents and job
+  # settings.
+  clip = job['clip']
+  return result_cache.cache_key([clip['sha1sum'], clip['frame_offset'], clip['num_frames'], job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], job['target_bitrates_kbps']])
+
+
+def manifest_entry(job):
+  clip = job['clip']
+  return {
+    'job-id': job_id(job),
+    'input-file': os.path.basename(clip['input_file']),
+    'input-file-sha1sum': clip['sha1sum'],
+    'frame-offset': clip['frame_offset'],
+    'num-frames': clip['num_frames'],
+    'encoder': job['encoder'],
+    'codec': job['codec'],
+    'layer-pattern': "%dsl%dtl" % (job['num_spatial_layers'], job['num_temporal_layers']),
+    'bitrate-config-kbps': job['target_bitrates_kbps'],
+  }
+
+
+def manifest_jobs(jobs, manifest):
+  # Jobs are matched by ID, so the command line has to name the same clips and
+  # settings as the one the manifest was dumped with.
+  job_ids = set(json.loads(line)['job-id'] for line in manifest if line.strip())
+  manifest.close()
+  jobs = [job for job in jobs if job_id(job) in job_ids]
+  if len(jobs) < len(job_ids):
+    sys.exit("ERROR: %d jobs in '%s' aren't generated by this command line." % (len(job_ids) - len(jobs), manifest.name))
   return jobs
 
+
+def shard_jobs(jobs, shard):
+  # Jobs are ordered by ID, so every host agrees on the contents of each shard
+  # no matter the order clips and encoders were given in.
+  (index, count) = shard
+  jobs = sorted(jobs, key=job_id)
+  return jobs[index::count]
+
+
+def claim_job(job, shard_dir):
+  # Lock files are created atomically, so each job is only claimed once by all
+  # processes sharing |shard_dir|.
+  lock_file = os.path.join(shard_dir, '%s.lock' % job_id(job))
+  try:
+    fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+  except OSError as e:
+    if e.errno == errno.EEXIST:
+      return False
+    raise
+  with os.fdopen(fd, 'w') as f:
+    f.write("%s %d %s\n" % (os.uname()[1], os.getpid(), job_to_string(job)))
+  return True
+
+
+def release_job(job, shard_dir):
+  # Failed jobs are released so that they can be retried.
+  try:
+    os.remove(os.path.join(shard_dir, '%s.lock' % job_id(job)))
+  except OSError:
+    pass
+
+
 def start_daemon(func):
   t = threading.Thread(target=func)
   t.daemon = True
@@ -560,57 +1508,328 @@ def start_daemon(func):
 def job_to_string(job):
     return "%s:%s %dsl%dtl %s %s" % (job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], ":".join(str(i) for i in job['target_bitrates_kbps']), os.path.basename(job['clip']['input_file']))
 
-def worker():
-  global args
-  global jobs
-  global current_job
-  global has_errored
-  global total_jobs
-  pp = pprint.PrettyPrinter(indent=2)
-  while True:
-    with thread_lock:
-      if not jobs:
-        return
-      (job, command, job_temp_dir) = jobs.pop()
+def job_encoder(job):
+  return "%s:%s" % (job['encoder'], job['codec'])
+
+def job_threads(job):
+  return libvpx_threads if job['encoder'] == 'libvpx-rt' else 1
+
+def job_preset(job):
+  return "%s:%s %dsl%dtl" % (job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'])
+
+def job_work(job):
+  clip = job['clip']
+  return clip['width'] * clip['height'] * clip['num_frames']
+
+def run_status():
+  queued = {}
+  remaining_cost = 0.0
+  for (cost, _, _, _, job) in job_scheduler.pending_jobs():
+    queued[job_encoder(job)] = queued.get(job_encoder(job), 0) + 1
+    remaining_cost += cost
+  stages = {'decode': decode_stage.occupancy(), 'metrics': metrics_stage.occupancy()}
+  scratch = [(directory, reserved, telemetry.directory_size(directory), budget) for (directory, reserved, budget) in job_scheduler.scratch_usage()]
+  return run_telemetry.status(queued, stages, scratch, remaining_cost)
 
-    (results, error) = run_command(job, command, job_temp_dir, args.encoded_file_dir)
 
-    job_str = job_to_string(job)
+def release_job_scratch(job):
+  # Also removes the job's temp dir, which failed jobs may have left behind.
+  if 'temp_dir' in job:
+    shutil.rmtree(job.pop('temp_dir'), ignore_errors=True)
+  if 'scratch' in job:
+    job_scheduler.scratch_done(*job.pop('scratch'))
 
+
+def report_job(job, results, status, error=None):
+  global current_job
+  global has_errored
+  # Searches hold the scheduler open until they're done, so they're continued
+  # even if reporting fails, and release their hold if continuing fails.
+  try:
+    release_job_scratch(job)
+    run_telemetry.job_done(job, status, results, job['clip']['num_frames'])
     with thread_lock:
       current_job += 1
-      run_ok = results is not None
-      print("[%d/%d] %s (%s)" % (current_job, total_jobs, job_str, "OK" if run_ok else "ERROR"))
-      if not run_ok:
+      print("[%d/%d] %s (%s)" % (current_job, total_jobs, job_to_string(job), status))
+      if results is None:
         has_errored = True
         print(error)
-      else:
+        if args.shard_dir:
+          release_job(job, args.shard_dir)
+      elif 'preview' not in job:
         for result in results:
-          args.out.write(pp.pformat(result))
-          args.out.write(',\n')
-        args.out.flush()
+          result_writer.write(result)
+    if 'preview' in job:
+      finish_preview_segment(job, results)
+  finally:
+    if 'search' in job:
+      try:
+        continue_search(job, results)
+      except Exception:
+        job_scheduler.release()
+        with thread_lock:
+          has_errored = True
+          print("Stopped search of %s:\n%s" % (job_to_string(job), traceback.format_exc()))
+
+
+class PipelineJob(object):
+  # State of a job whose layers are being decoded and measured by the decode
+  # and metrics stages.
+  def __init__(self, job, results, encoded_files, job_temp_dir, cache_key):
+    self.job = job
+    self.results = results
+    self.encoded_files = encoded_files
+    self.job_temp_dir = job_temp_dir
+    self.cache_key = cache_key
+    self.remaining_layers = len(encoded_files)
+    self.measure_jointly = measure_jointly(job, encoded_files)
+    self.decoded = [None] * len(encoded_files)
+    self.remaining_decodes = len(encoded_files)
+    self.error = None
+    self.lock = threading.Lock()
+
+  def layer_decoded(self, i, decoded, error=None):
+    # Returns True once all layers have been decoded (or failed to).
+    with self.lock:
+      if error and not self.error:
+        self.error = error
+      self.decoded[i] = decoded
+      self.remaining_decodes -= 1
+      return self.remaining_decodes == 0
+
+  def layer_done(self, error=None, layers=1):
+    with self.lock:
+      if error and not self.error:
+        self.error = error
+      self.remaining_layers -= layers
+      if self.remaining_layers > 0:
+        return
+    if self.error:
+      shutil.rmtree(self.job_temp_dir, ignore_errors=True)
+      report_job(self.job, None, "ERROR", self.error)
+      return
+    try:
+      finish_job(self.job, self.results, self.encoded_files, self.job_temp_dir, args.encoded_file_dir, self.cache_key)
+    except Exception:
+      report_job(self.job, None, "ERROR", traceback.format_exc())
+      return
+    report_job(self.job, self.results, "OK")
+
+
+def layer_error(pipeline_job, layer=None):
+  if layer is None:
+    return "%s (all layers)\n%s" % (job_to_string(pipeline_job.job), traceback.format_exc())
+  return "%s (layer sl%d tl%d)\n%s" % (job_to_string(pipeline_job.job), layer['spatial-layer'], layer['temporal-layer'], traceback.format_exc())
+
+
+def decode_worker(item):
+  (pipeline_job, i) = item
+  layer = pipeline_job.encoded_files[i]
+  decoded = None
+  error = None
+  if not pipeline_job.error:
+    try:
+      decoded = decode_layer(pipeline_job.results[i], pipeline_job.job, pipeline_job.job_temp_dir, layer)
+    except Exception:
+      error = layer_error(pipeline_job, layer)
+  if pipeline_job.measure_jointly:
+    # All layers are handed to the metrics stage together, once decoded.
+    if pipeline_job.layer_decoded(i, decoded, error):
+      metrics_stage.put((pipeline_job, None, pipeline_job.decoded))
+    return
+  if error or pipeline_job.error:
+    pipeline_job.layer_done(error)
+    return
+  metrics_stage.put((pipeline_job, i, decoded))
+
+
+def metrics_worker(item):
+  (pipeline_job, i, decoded) = item
+  if i is None:
+    layers = len(pipeline_job.encoded_files)
+    if pipeline_job.error:
+      pipeline_job.layer_done(layers=layers)
+      return
+    try:
+      measure_layers(pipeline_job.results, pipeline_job.job, pipeline_job.job_temp_dir, pipeline_job.encoded_files, decoded)
+    except Exception:
+      pipeline_job.layer_done(layer_error(pipeline_job), layers)
+      return
+    pipeline_job.layer_done(layers=layers)
+    return
+  layer = pipeline_job.encoded_files[i]
+  if pipeline_job.error:
+    pipeline_job.layer_done()
+    return
+  try:
+    measure_layer(pipeline_job.results[i], pipeline_job.job, pipeline_job.job_temp_dir, layer, decoded)
+  except Exception:
+    pipeline_job.layer_done(layer_error(pipeline_job, layer))
+    return
+  pipeline_job.layer_done()
+
+
+def encode_job(job, placement, start_time):
+  # Encode stage of a job. Returns the job to hand over to the decode stage, or
+  # the (results, status, error) to report it with right away.
+  if args.shard_dir and not claim_job(job, args.shard_dir):
+    return (None, ([], "CLAIMED ELSEWHERE", None))
+
+  # Temp dirs are created in the scratch directory the job was placed in, and
+  # removed by report_job() however the job ends.
+  job_temp_dir = tempfile.mkdtemp(dir=job_scratch.directories[placement])
+  job['temp_dir'] = job_temp_dir
+  (command, encoded_files) = job_command(job, job_temp_dir)
+
+  cache_key = None
+  if job_result_cache:
+    cache_key = job_cache_key(job, command, job_temp_dir)
+    results = load_cached_results(cache_key, job, encoded_files, job_temp_dir, args.encoded_file_dir)
+    if results is not None:
+      return (None, (results, "CACHED", None))
+
+  run_telemetry.encode_started()
+  try:
+    (results, output) = run_encoder(job, command, encoded_files)
+  finally:
+    run_telemetry.encode_done()
+  if results is None:
+    return (None, (None, "ERROR", output))
+  # Costs are learned per single encode, so that they also apply to runs
+  # without --isolated-timing.
+  encode_runs = args.timing_warmup_runs + args.timing_repetitions if args.isolated_timing else 1
+  job_cost_model.update(job_preset(job), job_work(job), (time.monotonic() - start_time) / encode_runs)
+  return (PipelineJob(job, results, encoded_files, job_temp_dir, cache_key), None)
+
+
+def worker():
+  # Encode stage. Encoded layers are handed over to the decode stage, so that
+  # encoders don't wait for metrics of finished jobs.
+  while True:
+    scheduled = job_scheduler.next_job()
+    if scheduled is None:
+      return
+    (admitted_job, placement) = scheduled
+    job = admitted_job[4]
+    job['scratch'] = (admitted_job, placement)
+    run_telemetry.job_started(job, job_encoder(job), admitted_job[0])
+    start_time = time.monotonic()
+
+    # Encoder threads are given back to the scheduler however the encode stage
+    # ends, or other workers would wait for them forever.
+    try:
+      (pipeline_job, report) = encode_job(job, placement, start_time)
+    except Exception:
+      (pipeline_job, report) = (None, (None, "ERROR", traceback.format_exc()))
+    finally:
+      job_scheduler.job_done(admitted_job)
+    if report:
+      report_job(job, *report)
+      continue
+
+    for i in range(len(pipeline_job.encoded_files)):
+      decode_stage.put((pipeline_job, i))
 
 
 thread_lock = threading.Lock()
+job_result_cache = None
+job_cost_model = None
+job_scheduler = None
+decode_stage = None
+metrics_stage = None
+metrics_backend_executor = None
+result_writer = None
+scaled_reference_lock = threading.Lock()
+scaled_reference_locks = {}
+reference_window_dir = None
+reference_window_lock = threading.Lock()
+reference_window_locks = {}
+bitrate_searches = []
+job_scratch = None
+encoder_cpu_sets = None
+run_telemetry = None
 
 def main():
   global args
-  global jobs
+  global job_result_cache
+  global job_cost_model
+  global job_scheduler
+  global decode_stage
+  global metrics_stage
+  global metrics_backend_executor
+  global result_writer
   global total_jobs
   global current_job
   global has_errored
+  global job_scratch
+  global encoder_cpu_sets
+  global run_telemetry
+  global reference_window_dir
 
   temp_dir = tempfile.mkdtemp()
 
   args = parser.parse_args()
-  prepare_clips(args, temp_dir)
-  jobs = generate_jobs(args, temp_dir)
+  if args.num_spatial_layers > 1:
+    if args.num_temporal_layers > 1:
+      sys.exit("ERROR: Spatial and temporal layers can't be combined yet.")
+    for (encoder, codec) in args.encoders:
+      if (encoder, codec) != ('libvpx-rt', 'vp9'):
+        sys.exit("ERROR: %s:%s doesn't support spatial layers." % (encoder, codec))
+    # Downscaled references are written by the NumPy metrics engine.
+    if yuv_metrics is None:
+      sys.exit("ERROR: --num-spatial-layers requires NumPy to be installed.")
+  if not args.scaled_reference_dir:
+    args.scaled_reference_dir = os.path.join(temp_dir, 'scaled')
+    os.mkdir(args.scaled_reference_dir)
+  reference_window_dir = os.path.join(temp_dir, 'windows')
+  os.mkdir(reference_window_dir)
+  if args.preview_segments:
+    if args.target_quality or args.shard or args.shard_dir or args.manifest:
+      sys.exit("ERROR: --preview-segments can't be combined with --target-quality or sharding.")
+    if yuv_metrics is None:
+      sys.exit("ERROR: --preview-segments requires NumPy to be installed.")
+  if args.isolated_timing:
+    if not hasattr(os, 'sched_setaffinity'):
+      sys.exit("ERROR: --isolated-timing requires os.sched_setaffinity(), which isn't available on this platform.")
+    # Encoders get CPUs of their own, so no more encoder threads may run at once
+    # than there are CPUs set aside for them. Everything else, including
+    # decoders and metrics tools started by the pipeline stages, is pinned to
+    # the remaining CPUs, which threads and processes started later inherit.
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+      sys.exit("ERROR: --isolated-timing requires at least 2 CPUs.")
+    if args.max_encoder_threads is None:
+      args.max_encoder_threads = len(cpus) // 2
+    args.max_encoder_threads = min(args.max_encoder_threads, len(cpus) - 1)
+    encoder_cpu_sets = scheduler.CpuSets(cpus[:args.max_encoder_threads])
+    os.sched_setaffinity(0, cpus[args.max_encoder_threads:])
+  elif args.max_encoder_threads is None:
+    args.max_encoder_threads = multiprocessing.cpu_count()
+  if args.target_quality:
+    if args.shard or args.shard_dir or args.manifest:
+      sys.exit("ERROR: --target-quality can't be combined with sharding.")
+    if not args.enable_vmaf and 'vmaf' in [metric for (metric, _) in args.target_quality]:
+      sys.exit("ERROR: Searching for a VMAF target requires --enable-vmaf.")
+  prepare_clips(args)
+  jobs = generate_jobs(args)
+  if args.manifest:
+    jobs = manifest_jobs(jobs, args.manifest)
+  if args.shard:
+    jobs = shard_jobs(jobs, args.shard)
   total_jobs = len(jobs)
   current_job = 0
   has_errored = False
 
+  if args.dump_manifest:
+    for entry in sorted((manifest_entry(job) for job in jobs), key=lambda entry: entry['job-id']):
+      args.dump_manifest.write(json.dumps(entry, sort_keys=True) + '\n')
+    args.dump_manifest.close()
+    shutil.rmtree(temp_dir)
+    return 0
+
   if args.dump_commands:
-    for (job, (command, encoded_files), job_temp_dir) in jobs:
+    for job in jobs:
+      (command, encoded_files) = job_command(job, tempfile.mkdtemp(dir=temp_dir))
       current_job += 1
       print("[%d/%d] %s" % (current_job, total_jobs, job_to_string(job)))
       print("> %s" % " ".join(command))
@@ -620,7 +1839,13 @@ def main():
     return 0
 
   # Make sure commands for quality metrics are present.
-  find_absolute_path(False, 'libvpx/tools/tiny_ssim')
+  if args.metrics_engine == 'numpy':
+    if yuv_metrics is None:
+      sys.exit("ERROR: --metrics-engine=numpy requires NumPy to be installed.")
+  elif args.stream_decode:
+    sys.exit("ERROR: --stream-decode requires --metrics-engine=numpy.")
+  else:
+    find_absolute_path(False, 'libvpx/tools/tiny_ssim')
   for (encoder, codec) in args.encoders:
     if codec in ['vp8', 'vp9']:
       find_absolute_path(False, 'libvpx/vpxdec')
@@ -631,15 +1856,75 @@ def main():
   if args.enable_vmaf:
     find_absolute_path(False, 'vmaf/run_vmaf')
 
-  print("[0/%d] Running jobs..." % total_jobs)
+  if args.cache_dir:
+    job_result_cache = result_cache.ResultCache(args.cache_dir, args.cache_max_size_mb * 1024 * 1024 if args.cache_max_size_mb else None, args.cache_max_age_days * 24 * 60 * 60 if args.cache_max_age_days else None)
+
+  job_cost_model = scheduler.CostModel(args.cost_model)
+  # Job temp dirs go on a tmpfs while they fit within its budget, and on disk
+  # otherwise.
+  scratch_dirs = []
+  tmpfs_temp_dir = None
+  if args.tmpfs_dir:
+    tmpfs_temp_dir = tempfile.mkdtemp(dir=args.tmpfs_dir)
+    tmpfs_budget = args.tmpfs_budget_mb * 1024 * 1024 if args.tmpfs_budget_mb is not None else shutil.disk_usage(args.tmpfs_dir).free // 2
+    scratch_dirs.append((tmpfs_temp_dir, tmpfs_budget))
+  scratch_budget = args.scratch_budget_mb * 1024 * 1024 if args.scratch_budget_mb is not None else shutil.disk_usage(temp_dir).free * 9 // 10
+  scratch_dirs.append((temp_dir, scratch_budget))
+  job_scratch = scheduler.ScratchSpace(scratch_dirs)
+
+  # Encoder commands are built as jobs start, make sure their binaries are
+  # present before that.
+  probe_dir = tempfile.mkdtemp(dir=temp_dir)
+  for preset_job in dict((job_preset(job), job) for job in jobs).values():
+    job_command(dict(preset_job), probe_dir)
+  shutil.rmtree(probe_dir)
+
+  job_scheduler = scheduler.JobScheduler([scheduled_job(job) for job in jobs], args.max_encoder_threads, job_scratch)
+  for search in bitrate_searches:
+    job_scheduler.hold()
+  run_telemetry = telemetry.Telemetry()
 
-  args.out.write('[')
+  print("[0/%d] Running jobs..." % total_jobs)
 
+  result_writer = results_io.ResultWriter(args.out, args.out_format)
+  result_writer.begin()
+
+  # Decoded layers queue up for the metrics stage. Bounding that queue bounds the
+  # number of decoded files on disk.
+  # Each layer being measured runs at most one metric backend (VMAF) beside the
+  # one in its own thread.
+  metrics_backend_executor = concurrent.futures.ThreadPoolExecutor(args.metrics_workers)
+  metrics_stage = scheduler.Stage(metrics_worker, args.metrics_workers, args.metrics_workers)
+  decode_stage = scheduler.Stage(decode_worker, args.decode_workers, 2 * args.decode_workers)
+  telemetry_server = None
+  if args.telemetry_port:
+    telemetry_server = telemetry.serve(args.telemetry_port, run_status)
+  status_file = None
+  if args.status_file:
+    status_file = telemetry.StatusFile(args.status_file, args.status_interval, run_status)
   workers = [start_daemon(worker) for i in range(args.workers)]
   [t.join() for t in workers]
-
-  args.out.write(']\n')
-
+  decode_stage.finish()
+  metrics_stage.finish()
+  metrics_backend_executor.shutdown()
+
+  result_writer.end()
+  job_cost_model.save()
+  if args.target_quality:
+    write_search_results(args.search_out)
+  if status_file:
+    status_file.stop()
+  if telemetry_server:
+    telemetry_server.shutdown()
+    telemetry_server.server_close()
+
+  if job_result_cache:
+    evicted = job_result_cache.evict()
+    if evicted:
+      print("Evicted %d cache entr%s." % (evicted, "y" if evicted == 1 else "ies"))
+
+  if tmpfs_temp_dir:
+    shutil.rmtree(tmpfs_temp_dir)
   shutil.rmtree(temp_dir)
   return 1 if has_errored else 0
 
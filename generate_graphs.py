@@ -14,10 +14,22 @@
 # limitations under the License.
 
 import argparse
-import ast
+import hashlib
+import json
+import matplotlib
+# Rendering happens in worker processes without a display.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import multiprocessing
 import os
 import re
+import results_io
+import tempfile
+
+# Bump when changing how graphs are drawn, so that unchanged graph data still
+# gets re-rendered.
+GRAPH_STYLE_VERSION = 1
+MANIFEST_FILE = '.graphs-manifest.json'
 
 layer_regex_pattern = re.compile(r"^(\d)sl(\d)tl$")
 def writable_dir(directory):
@@ -25,6 +37,12 @@ def writable_dir(directory):
     raise argparse.ArgumentTypeError("'%s' is either not a directory or cannot be opened for writing.\n" % directory)
   return directory
 
+def positive_int(num):
+  num_int = int(num)
+  if num_int <= 0:
+    raise argparse.ArgumentTypeError("'%s' is not a positive integer.\n" % num)
+  return num_int
+
 def formats(formats_list):
   formats = formats_list.split(',')
   for extension in formats:
@@ -34,74 +52,193 @@ def formats(formats_list):
 
 
 parser = argparse.ArgumentParser(description='Generate graphs from data files.')
-parser.add_argument('graph_files', nargs='+', metavar='graph_file.txt', type=argparse.FileType('r'))
+parser.add_argument('graph_files', nargs='+', metavar='graph_file.jsonl', type=argparse.FileType('r'))
 parser.add_argument('--out-dir', required=True, type=writable_dir)
 parser.add_argument('--formats', type=formats, metavar='png,svg', help='comma-separated list of output formats', default=['png', 'svg'])
-
-def split_data(graph_data, attribute):
-  groups = {}
-  for element in graph_data:
-    value = element[attribute]
-    if value not in groups:
-      groups[value] = []
-    groups[value].append(element)
-  return list(groups.values())
+parser.add_argument('--workers', type=positive_int, default=multiprocessing.cpu_count(), help='number of processes rendering graphs')
+parser.add_argument('--force', action='store_true', help='re-render all graphs, even those whose data is unchanged')
 
 def normalize_bitrate_config_string(config):
   return ":".join([str(int(x * 100.0 / config[-1])) for x in config])
 
 
-def generate_graphs(output_dict, graph_data, target_metric, bitrate_config_string):
+def index_summary_data(graph_data):
+  # Groups points in a single pass by the summary graph they belong to, and by
+  # line within that graph.
+  index = {}
+  for point in graph_data:
+    graph_key = (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']))
+    line_key = (point['encoder'], point['codec'], point['spatial-layer'], point['temporal-layer'])
+    index.setdefault(graph_key, {}).setdefault(line_key, []).append(point)
+  return index
+
+
+def generate_graphs(output_dict, graph_key, graph_lines, target_metric):
   lines = {}
-  for encoder in split_data(graph_data, 'encoder'):
-    for codec in split_data(encoder, 'codec'):
-      for layer in split_data(codec, 'temporal-layer'):
-        metric_data = []
-        for data in layer:
-          if target_metric not in data:
-            return
-          metric_data.append((data['target-bitrate-bps']/1000, data[target_metric], data['bitrate-utilization']))
-        line_name = '%s:%s (tl%d)' % (layer[0]['encoder'], layer[0]['codec'], layer[0]['temporal-layer'])
-        # Sort points on target bitrate.
-        lines[line_name] = sorted(metric_data, key=lambda point: point[0])
-
-  graph_name = "%s-%s-%s:%s" % (graph_data[0]['input-file'], graph_data[0]['layer-pattern'], bitrate_config_string, target_metric)
+  num_spatial_layers = int(layer_regex_pattern.match(graph_key[1]).group(1))
+  for ((encoder, codec, spatial_layer, temporal_layer), layer) in graph_lines.items():
+    metric_data = []
+    for data in layer:
+      if target_metric not in data:
+        return
+      metric_data.append((data['target-bitrate-bps']/1000, data[target_metric], data['bitrate-utilization']))
+    # Lines of single spatial layer patterns keep their old names.
+    line_name = '%s:%s (tl%d)' % (encoder, codec, temporal_layer)
+    if num_spatial_layers > 1:
+      line_name = '%s:%s (sl%d tl%d)' % (encoder, codec, spatial_layer, temporal_layer)
+    # Sort points on target bitrate.
+    lines[line_name] = sorted(metric_data, key=lambda point: point[0])
+
+  graph_name = "%s-%s-%s:%s" % (graph_key + (target_metric, ))
   output_dict[('', graph_name)] = lines
 
+def graph_file(subdir, graph_name, extension):
+  return os.path.join(extension, subdir, "%s.%s" % (graph_name.replace(":", "-"), extension))
+
+
+def graph_hash(subdir, graph_name, lines):
+  # Covers everything a rendered graph depends on: its name (which picks the
+  # axes and labels used), line data and the drawing code.
+  key_data = [GRAPH_STYLE_VERSION, matplotlib.__version__, subdir, graph_name, lines]
+  return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_manifest(out_dir):
+  try:
+    with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def write_manifest(out_dir, manifest):
+  (fd, temp_file) = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(temp_file, os.path.join(out_dir, MANIFEST_FILE))
+
+
+def prune_graphs(out_dir, stale_files):
+  for name in stale_files:
+    path = os.path.join(out_dir, name)
+    if os.path.isfile(path):
+      os.remove(path)
+    # Remove directories emptied by pruning, but never out_dir itself.
+    graph_dir = os.path.dirname(path)
+    while os.path.abspath(graph_dir) != os.path.abspath(out_dir):
+      try:
+        os.rmdir(graph_dir)
+      except OSError:
+        break
+      graph_dir = os.path.dirname(graph_dir)
+
+
+def render_graph(work_item):
+  (subdir, graph_name, lines, out_dir, formats) = work_item
+  metric = graph_name.split(':')[-1]
+  fig, ax = plt.subplots()
+  ax.set_title(graph_name)
+  frame_data = 'frame-' in metric
+  ax2 = None
+  ax2_bitrate_utilization = False
+  linestyle = 'o--'
+  ax2_linestyle = 'x-'
+
+  if frame_data:
+    ax.set_xlabel('Frame')
+    linestyle = '-'
+    if metric == 'frame-bytes':
+      ax.set_ylabel('Frame Size (bytes / frame)')
+    else:
+      ax.set_ylabel(metric.replace('frame-', '').upper())
+      ax2 = ax.twinx()
+      ax2.set_ylabel('Frame Size (bytes / frame)')
+      ax2_linestyle = '-'
+  elif metric == 'encode-time-utilization':
+    ax.set_xlabel('Layer Target Bitrate (kbps)')
+    ax.set_ylabel('Encode Time (fraction)')
+    # Draw a reference line for realtime.
+    ax.axhline(1.0, color='k', alpha=0.2, linestyle='--')
+  else:
+    ax.set_xlabel('Layer Target Bitrate (kbps)')
+    ax.set_ylabel(metric.upper())
+    ax2 = ax.twinx()
+    ax2.set_ylabel('Bitrate Utilization (actual / target)')
+    ax2_bitrate_utilization = True
+
+  for title in sorted(lines.keys()):
+    points = lines[title]
+    x = []
+    y = []
+    y2 = []
+    for bitrate_kbps, value, utilization in points:
+        x.append(bitrate_kbps)
+        y.append(value)
+        y2.append(utilization)
+    ax.plot(x, y, linestyle, linewidth=1, label=title)
+    if ax2:
+      ax2.plot(x, y2, ax2_linestyle, alpha=0.2)
+    ax.legend(loc='best', fancybox=True, framealpha=0.5)
+
+  if metric == 'encode-time-utilization':
+    # Make sure the horizontal reference line at 1.0 can be seen.
+    (lower, upper) = ax.get_ylim()
+    if upper < 1.10:
+      ax.set_ylim(top=1.10)
+
+  # TODO(pbos): Read 'input-total-frames' from input and set as graph xlim.
+  if frame_data:
+    ax.set_xlim(left=0)
+
+  if ax2_bitrate_utilization:
+    # Set bitrate limit axes to +/- 20%.
+    ax2.set_ylim(bottom=0.80, top=1.20)
+
+  for extension in formats:
+    path = os.path.join(out_dir, graph_file(subdir, graph_name, extension))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    plt.savefig(path)
+  plt.close()
+  return graph_name
+
+
 def main():
   args = parser.parse_args()
   graph_data = []
   for f in args.graph_files:
-    graph_data += ast.literal_eval(f.read())
+    graph_data += results_io.read_results(f)
 
   graph_dict = {}
-  for input_files in split_data(graph_data, 'input-file'):
-    for layer_pattern in split_data(input_files, 'layer-pattern'):
-      for data in layer_pattern:
-        metrics = [
-          'vpx-ssim',
-          'ssim',
-          'ssim-y',
-          'ssim-u',
-          'ssim-v',
-          'avg-psnr',
-          'avg-psnr-y',
-          'avg-psnr-u',
-          'avg-psnr-v',
-          'glb-psnr',
-          'glb-psnr-y',
-          'glb-psnr-u',
-          'glb-psnr-v',
-          'encode-time-utilization',
-          'vmaf'
-        ]
-        for metric in metrics:
-          generate_graphs(graph_dict, layer_pattern, metric, normalize_bitrate_config_string(data['bitrate-config-kbps']))
+  metrics = [
+    'vpx-ssim',
+    'ssim',
+    'ssim-y',
+    'ssim-u',
+    'ssim-v',
+    'avg-psnr',
+    'avg-psnr-y',
+    'avg-psnr-u',
+    'avg-psnr-v',
+    'glb-psnr',
+    'glb-psnr-y',
+    'glb-psnr-u',
+    'glb-psnr-v',
+    'encode-time-utilization',
+    'vmaf'
+  ]
+  for (graph_key, graph_lines) in index_summary_data(graph_data).items():
+    for metric in metrics:
+      generate_graphs(graph_dict, graph_key, graph_lines, metric)
 
   for point in graph_data:
     pattern_match = layer_regex_pattern.match(point['layer-pattern'])
+    num_spatial_layers = int(pattern_match.group(1))
     num_temporal_layers = int(pattern_match.group(2))
     temporal_divide = 2 ** (num_temporal_layers - 1 - point['temporal-layer'])
+    # Graphs for single spatial layer patterns keep their old names.
+    layer_name = 'tl%d' % point['temporal-layer']
+    if num_spatial_layers > 1:
+      layer_name = 'sl%d%s' % (point['spatial-layer'], layer_name)
     frame_metrics = [
       'frame-ssim',
       'frame-ssim-y',
@@ -122,10 +259,10 @@ def main():
       split_on_codecs = target_metric == 'frame-qp'
 
       if split_on_codecs:
-        graph_name = "%s-%s-%s-%dkbps-tl%d-%s:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], point['temporal-layer'], point['codec'], target_metric)
+        graph_name = "%s-%s-%s-%dkbps-%s-%s:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], layer_name, point['codec'], target_metric)
         line_name = '%s' % point['encoder']
       else:
-        graph_name = "%s-%s-%s-%dkbps-tl%d:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], point['temporal-layer'], target_metric)
+        graph_name = "%s-%s-%s-%dkbps-%s:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], layer_name, target_metric)
         line_name = '%s:%s' % (point['encoder'], point['codec'])
       graph_info = ('frame-data-%s/' % point['input-file'], graph_name)
       if not graph_info in graph_dict:
@@ -136,76 +273,55 @@ def main():
         line.append((point['frame-offset'] + temporal_divide * idx + 1, val, frame_size))
       graph_dict[graph_info][line_name] = line
 
-  current_graph = 1
-  total_graphs = len(graph_dict)
-  for (subdir, graph_name), lines in list(graph_dict.items()):
-    print(("[%d/%d] %s" % (current_graph, total_graphs, graph_name)))
-    current_graph += 1
-    metric = graph_name.split(':')[-1]
-    fig, ax = plt.subplots()
-    ax.set_title(graph_name)
-    frame_data = 'frame-' in metric
-    ax2 = None
-    ax2_bitrate_utilization = False
-    linestyle = 'o--'
-    ax2_linestyle = 'x-'
-
-    if frame_data:
-      ax.set_xlabel('Frame')
-      linestyle = '-'
-      if metric == 'frame-bytes':
-        ax.set_ylabel('Frame Size (bytes / frame)')
-      else:
-        ax.set_ylabel(metric.replace('frame-', '').upper())
-        ax2 = ax.twinx()
-        ax2.set_ylabel('Frame Size (bytes / frame)')
-        ax2_linestyle = '-'
-    elif metric == 'encode-time-utilization':
-      ax.set_xlabel('Layer Target Bitrate (kbps)')
-      ax.set_ylabel('Encode Time (fraction)')
-      # Draw a reference line for realtime.
-      ax.axhline(1.0, color='k', alpha=0.2, linestyle='--')
-    else:
-      ax.set_xlabel('Layer Target Bitrate (kbps)')
-      ax.set_ylabel(metric.upper())
-      ax2 = ax.twinx()
-      ax2.set_ylabel('Bitrate Utilization (actual / target)')
-      ax2_bitrate_utilization = True
-
-    for title in sorted(lines.keys()):
-      points = lines[title]
-      x = []
-      y = []
-      y2 = []
-      for bitrate_kbps, value, utilization in points:
-          x.append(bitrate_kbps)
-          y.append(value)
-          y2.append(utilization)
-      ax.plot(x, y, linestyle, linewidth=1, label=title)
-      if ax2:
-        ax2.plot(x, y2, ax2_linestyle, alpha=0.2)
-      ax.legend(loc='best', fancybox=True, framealpha=0.5)
-
-    if metric == 'encode-time-utilization':
-      # Make sure the horizontal reference line at 1.0 can be seen.
-      (lower, upper) = ax.get_ylim()
-      if upper < 1.10:
-        ax.set_ylim(top=1.10)
-
-    # TODO(pbos): Read 'input-total-frames' from input and set as graph xlim.
-    if frame_data:
-      ax.set_xlim(left=0)
-
-    if ax2_bitrate_utilization:
-      # Set bitrate limit axes to +/- 20%.
-      ax2.set_ylim(bottom=0.80, top=1.20)
-
-    for extension in args.formats:
-      graph_dir =  os.path.join(args.out_dir, extension, subdir)
-      if not os.path.exists(graph_dir):
-        os.makedirs(graph_dir)
-      plt.savefig(os.path.join(graph_dir, "%s.%s" % (graph_name.replace(":", "-"), extension)))
-    plt.close()
+  # The manifest maps each graph file to a hash of its inputs. Graphs with
+  # unchanged hashes are not re-rendered, and graphs no longer generated from
+  # the data are removed. Files in formats not being rendered are left alone.
+  old_manifest = read_manifest(args.out_dir)
+  manifest = {}
+  for (name, file_hash) in old_manifest.items():
+    if name.split(os.sep)[0] not in args.formats:
+      manifest[name] = file_hash
+  current_files = set()
+  work_items = []
+  for ((subdir, graph_name), lines) in sorted(graph_dict.items()):
+    current_hash = graph_hash(subdir, graph_name, lines)
+    files = [graph_file(subdir, graph_name, extension) for extension in args.formats]
+    current_files.update(files)
+    if not args.force and all(old_manifest.get(name) == current_hash and os.path.isfile(os.path.join(args.out_dir, name)) for name in files):
+      for name in files:
+        manifest[name] = current_hash
+      continue
+    work_items.append(((subdir, graph_name, lines, args.out_dir, args.formats), files, current_hash))
+
+  stale_files = sorted(name for name in old_manifest if name not in manifest and name not in current_files)
+  prune_graphs(args.out_dir, stale_files)
+  for name in stale_files:
+    print("Removed stale graph %s" % name)
+
+  total_graphs = len(work_items)
+  print("Rendering %d graphs, %d unchanged." % (total_graphs, len(graph_dict) - total_graphs))
+  # Graphs are rendered in sorted order across a pool of processes, so output is
+  # the same regardless of the number of processes used.
+  chunksize = max(1, min(16, total_graphs // (4 * args.workers)))
+  pool = multiprocessing.Pool(args.workers)
+  try:
+    rendered = pool.imap(render_graph, [work_item for (work_item, _, _) in work_items], chunksize)
+    for (current_graph, graph_name) in enumerate(rendered, 1):
+      print("[%d/%d] %s" % (current_graph, total_graphs, graph_name))
+      (_, files, current_hash) = work_items[current_graph - 1]
+      for name in files:
+        manifest[name] = current_hash
+  finally:
+    pool.close()
+    pool.join()
+    # Hashes are recorded as graphs are rendered, so an interrupted run only
+    # re-renders what it didn't get to. Files that weren't rendered again keep
+    # their old entry so they can still be pruned later.
+    for (_, files, _) in work_items:
+      for name in files:
+        if name not in manifest and name in old_manifest:
+          manifest[name] = old_manifest[name]
+    write_manifest(args.out_dir, manifest)
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import tempfile
+
+import results_io
+
+# Results that should be identical when the same job is run on different hosts.
+# Timing and resource usage are expected to differ.
+DETERMINISTIC_KEYS = ['actual-bitrate-bps', 'frame-count', 'avg-psnr', 'ssim', 'vmaf']
+
+parser = argparse.ArgumentParser(description='Merge result files from sharded generate_data.py runs.')
+parser.add_argument('graph_files', nargs='+', metavar='graph_file.jsonl', type=argparse.FileType('r'))
+parser.add_argument('--out', required=True, metavar='output.jsonl', help='merged results, only written once all input files have been read and checked')
+parser.add_argument('--out-format', default='jsonl', choices=results_io.FORMATS, help='write results as JSON Lines or as a legacy Python list of dicts')
+
+
+def result_key(result):
+  # Identifies the job and layer a result belongs to. Results written before
+  # num-frames was recorded only match each other.
+  return (result['input-file-sha1sum'], result['frame-offset'], result.get('num-frames'), result['fps'], result['encoder'], result['codec'], result['layer-pattern'], tuple(result['bitrate-config-kbps']), result['spatial-layer'], result['temporal-layer'])
+
+
+def main():
+  args = parser.parse_args()
+  results = {}
+  clip_sha1sums = {}
+  errors = []
+  duplicates = 0
+  for f in args.graph_files:
+    for result in results_io.read_results(f):
+      # The same clip name with different contents means hosts didn't run on
+      # the same input, so their results can't be compared.
+      sha1sum = clip_sha1sums.setdefault(result['input-file'], result['input-file-sha1sum'])
+      if sha1sum != result['input-file-sha1sum']:
+        errors.append("%s: '%s' has SHA-1 sum %s, expected %s." % (f.name, result['input-file'], result['input-file-sha1sum'], sha1sum))
+        continue
+      key = result_key(result)
+      if key not in results:
+        results[key] = result
+        continue
+      duplicates += 1
+      previous = results[key]
+      for metric in DETERMINISTIC_KEYS:
+        if previous.get(metric) != result.get(metric):
+          print("WARNING: %s: duplicate result for %s:%s %s differs in '%s' (%s, previously %s)." % (f.name, result['encoder'], result['codec'], result['input-file'], metric, result.get(metric), previous.get(metric)), file=sys.stderr)
+          break
+
+  if errors:
+    for error in errors:
+      print("ERROR: %s" % error, file=sys.stderr)
+    return 1
+
+  # Written to a temp file first, so that --out may also be one of the inputs
+  # and is left as is if merging fails.
+  (fd, temp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(args.out)), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as out:
+      writer = results_io.ResultWriter(out, args.out_format)
+      writer.begin()
+      for key in sorted(results, key=repr):
+        writer.write(results[key])
+      writer.end()
+    results_io.make_readable(temp_file)
+    os.replace(temp_file, args.out)
+  except BaseException:
+    os.remove(temp_file)
+    raise
+  print("Merged %d results, dropped %d duplicates." % (len(results), duplicates))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,157 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Segment sampling for generate_data.py --preview-segments.
+#
+# Clip windows are split into equally long strata, and a short segment is
+# encoded from each. Segments are picked so that their temporal activity is
+# closest to that of their stratum, without crossing scene cuts. Results of
+# all segments of a job are then combined into a single result per layer, with
+# weighted means and 95% confidence intervals for quality and bitrate.
+
+import math
+import re
+import threading
+
+# Frames whose activity is this many times the median activity are scene cuts.
+SCENE_CUT_FACTOR = 4.0
+
+AVERAGED_KEYS = [
+  'actual-bitrate-bps',
+  'container-bitrate-bps',
+  'bitrate-utilization',
+  'encode-time-utilization',
+  'encode-cpu-time-ms-per-frame',
+  'encode-fps-median',
+]
+SUMMED_KEYS = ['actual-encode-time-ms', 'target-encode-time-ms', 'frame-count', 'num-frames', 'encode-time-ms-median']
+# Dispersion of --isolated-timing runs only applies to a single segment.
+DROPPED_KEYS = ['encode-time-ms-stdev', 'encode-fps-stdev']
+summed_usage_pattern = re.compile(r"^\w+-(wall-time-ms|user-time-ms|sys-time-ms|block-input-ops|block-output-ops)$")
+max_usage_pattern = re.compile(r"^\w+-max-rss-kb$")
+
+# Two-sided 95% quantiles of Student's t-distribution by degrees of freedom.
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228]
+
+
+def t_quantile_95(dof):
+  if dof <= len(T_95):
+    return T_95[dof - 1]
+  # Cornish-Fisher expansion, within 0.005 of exact values from here on.
+  z = 1.959964
+  return z + (z ** 3 + z) / (4 * dof) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * dof ** 2)
+
+
+def select_segments(activity, num_segments, segment_frames):
+  # |activity| has one value per frame of the window, see
+  # yuv_metrics.temporal_activity(). Returns (first frame, frames, weight) for
+  # each segment, relative to the window.
+  num_frames = len(activity)
+  if num_frames <= num_segments * segment_frames:
+    return [(0, num_frames, 1.0)]
+  median = sorted(activity)[num_frames // 2]
+  cut_threshold = SCENE_CUT_FACTOR * max(median, 1.0)
+  # Prefix sums of activity and cuts, where a cut at the first frame of a
+  # segment doesn't count since it starts with a keyframe anyway.
+  activity_sums = [0.0]
+  cut_sums = [0]
+  for value in activity:
+    activity_sums.append(activity_sums[-1] + value)
+    cut_sums.append(cut_sums[-1] + (value > cut_threshold))
+  segments = []
+  for i in range(num_segments):
+    start = i * num_frames // num_segments
+    end = (i + 1) * num_frames // num_segments
+    stratum_activity = (activity_sums[end] - activity_sums[start + 1]) / max(1, end - start - 1)
+    best = None
+    for first in range(start, end - segment_frames + 1):
+      last = first + segment_frames
+      segment_activity = (activity_sums[last] - activity_sums[first + 1]) / max(1, segment_frames - 1)
+      cuts = cut_sums[last] - cut_sums[first + 1]
+      score = (cuts, abs(segment_activity - stratum_activity))
+      if best is None or score < best[0]:
+        best = (score, first)
+    segments.append((best[1], segment_frames, (end - start) / num_frames))
+  return segments
+
+
+def weighted_mean_ci(values, weights):
+  # Weighted mean with a 95% confidence interval, treating segments as a
+  # stratified sample with one segment per stratum. Strata are collapsed to
+  # estimate variance, which is conservative. The interval is None for a single
+  # segment.
+  mean = sum(w * v for (w, v) in zip(weights, values)) / sum(weights)
+  n = len(values)
+  if n < 2:
+    return (mean, None)
+  plain_mean = sum(values) / n
+  variance = sum((v - plain_mean) ** 2 for v in values) / (n - 1)
+  standard_error = math.sqrt(variance * sum(w * w for w in weights)) / sum(weights)
+  margin = t_quantile_95(n - 1) * standard_error
+  return (mean, [mean - margin, mean + margin])
+
+
+def aggregate_layer(layer_results, weights, segments, averaged_keys):
+  result = dict((key, value) for (key, value) in layer_results[0].items() if not isinstance(value, list))
+  result['bitrate-config-kbps'] = layer_results[0]['bitrate-config-kbps']
+  for key in list(result):
+    if key in DROPPED_KEYS or any(key not in segment for segment in layer_results):
+      del result[key]
+      continue
+    values = [segment[key] for segment in layer_results]
+    if key in averaged_keys:
+      (result[key], interval) = weighted_mean_ci(values, weights)
+      if interval:
+        result['%s-ci95' % key] = interval
+    elif key in SUMMED_KEYS or summed_usage_pattern.match(key):
+      result[key] = sum(values)
+    elif max_usage_pattern.match(key):
+      result[key] = max(values)
+  result['preview-segments'] = [list(segment) for segment in segments]
+  return result
+
+
+class SegmentGroup(object):
+  # Collects results of the jobs encoding each segment of a clip at the same
+  # settings. |segments| are (frame offset, frames) in the clip, whose window
+  # starts at |frame_offset|.
+  def __init__(self, frame_offset, segments, weights, quality_metrics):
+    self.frame_offset = frame_offset
+    self.segments = segments
+    self.weights = weights
+    self.averaged_keys = AVERAGED_KEYS + quality_metrics
+    self.results = [None] * len(segments)
+    self.remaining = len(segments)
+    self.failed = False
+    self.lock = threading.Lock()
+
+  def add(self, index, results):
+    # Returns True for the last segment to finish.
+    with self.lock:
+      if results is None:
+        self.failed = True
+      self.results[index] = results
+      self.remaining -= 1
+      return self.remaining == 0
+
+  def aggregate(self):
+    # One result per layer, or None if any segment failed.
+    if self.failed:
+      return None
+    aggregated = []
+    for layer_results in zip(*self.results):
+      result = aggregate_layer(layer_results, self.weights, self.segments, self.averaged_keys)
+      result['frame-offset'] = self.frame_offset
+      aggregated.append(result)
+    return aggregated
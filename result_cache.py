@@ -0,0 +1,117 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent, content-addressed cache of job results. Entries are directories
+# named after the SHA-1 of everything that influences a job's output (see
+# generate_data.job_cache_key) and hold the job's result dicts, optionally along
+# with its encoded files.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+RESULTS_FILE = 'results.json'
+
+
+def cache_key(key_data):
+  return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+  def __init__(self, cache_dir, max_bytes=None, max_age_seconds=None):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.max_age_seconds = max_age_seconds
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def get(self, key, need_files=False):
+    # Returns (results, encoded_files) or None on a cache miss, where
+    # encoded_files are paths inside the cache entry (in layer order).
+    entry_dir = self._entry_dir(key)
+    try:
+      with open(os.path.join(entry_dir, RESULTS_FILE)) as f:
+        entry = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    encoded_files = [os.path.join(entry_dir, name) for name in entry['encoded-files']]
+    if need_files and (not encoded_files or not all(os.path.isfile(f) for f in encoded_files)):
+      return None
+    # Entry mtimes track last use, which is what eviction goes by.
+    os.utime(entry_dir, None)
+    return (entry['results'], encoded_files)
+
+  def put(self, key, results, encoded_files=()):
+    # Entries are staged in a temporary directory and renamed into place, so
+    # concurrent readers never see partially written entries.
+    entry_dir = self._entry_dir(key)
+    parent_dir = os.path.dirname(entry_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.staging-')
+    names = []
+    for (i, encoded_file) in enumerate(encoded_files):
+      name = 'layer-%d%s' % (i, os.path.splitext(encoded_file)[1])
+      shutil.copyfile(encoded_file, os.path.join(staging_dir, name))
+      names.append(name)
+    with open(os.path.join(staging_dir, RESULTS_FILE), 'w') as f:
+      json.dump({'results': results, 'encoded-files': names}, f)
+    if os.path.isdir(entry_dir):
+      shutil.rmtree(entry_dir, ignore_errors=True)
+    try:
+      os.rename(staging_dir, entry_dir)
+    except OSError:
+      # Another process stored the same entry first.
+      shutil.rmtree(staging_dir, ignore_errors=True)
+
+  def _entries(self):
+    entries = []
+    if not os.path.isdir(self.cache_dir):
+      return entries
+    for prefix in os.listdir(self.cache_dir):
+      prefix_dir = os.path.join(self.cache_dir, prefix)
+      if not os.path.isdir(prefix_dir):
+        continue
+      for key in os.listdir(prefix_dir):
+        if key.startswith('.'):
+          continue
+        entry_dir = os.path.join(prefix_dir, key)
+        size = 0
+        for name in os.listdir(entry_dir):
+          size += os.path.getsize(os.path.join(entry_dir, name))
+        entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+    return entries
+
+  def evict(self):
+    # Drops entries unused for longer than max_age_seconds, then least recently
+    # used entries until the cache fits within max_bytes. Returns the number of
+    # evicted entries.
+    entries = sorted(self._entries())
+    evicted = []
+    if self.max_age_seconds is not None:
+      oldest_allowed = time.time() - self.max_age_seconds
+      evicted += [entry for entry in entries if entry[0] < oldest_allowed]
+      entries = [entry for entry in entries if entry[0] >= oldest_allowed]
+    if self.max_bytes is not None:
+      total_bytes = sum(size for (_, size, _) in entries)
+      while entries and total_bytes > self.max_bytes:
+        entry = entries.pop(0)
+        total_bytes -= entry[1]
+        evicted.append(entry)
+    for (_, _, entry_dir) in evicted:
+      shutil.rmtree(entry_dir, ignore_errors=True)
+    return len(evicted)
@@ -0,0 +1,105 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reading and writing of result files produced by generate_data.py.
+#
+# Results are written as JSON Lines, one result dict per line, so that they can
+# be read back incrementally and a crashed run leaves at most a truncated last
+# line behind. The legacy format, a pprint'ed Python list of dicts, is still
+# accepted when reading.
+
+import ast
+import json
+import os
+import pprint
+import sys
+
+FORMATS = ['jsonl', 'legacy']
+
+
+class ResultWriter(object):
+  def __init__(self, out, output_format='jsonl'):
+    self.out = out
+    self.output_format = output_format
+    self.pp = pprint.PrettyPrinter(indent=2)
+
+  def begin(self):
+    if self.output_format == 'legacy':
+      self.out.write('[')
+
+  def write(self, result):
+    # Each result is written and flushed as a whole, a single line in JSON Lines.
+    if self.output_format == 'legacy':
+      self.out.write(self.pp.pformat(result) + ',\n')
+    else:
+      self.out.write(json.dumps(result, sort_keys=True) + '\n')
+    self.out.flush()
+
+  def end(self):
+    if self.output_format == 'legacy':
+      self.out.write(']\n')
+    self.out.flush()
+
+
+def _umask():
+  # Linux reports the umask in /proc, elsewhere it can only be read by setting
+  # it.
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('Umask:'):
+          return int(line.split()[1], 8)
+  except OSError:
+    pass
+  umask = os.umask(0o22)
+  os.umask(umask)
+  return umask
+
+
+def make_readable(temp_file):
+  # mkstemp() files are only readable by their owner, this gives them the
+  # permissions of a file opened for writing directly.
+  os.chmod(temp_file, 0o666 & ~_umask())
+
+
+def _read_legacy(data, name):
+  try:
+    return ast.literal_eval(data)
+  except SyntaxError:
+    # Runs that didn't finish are missing the closing bracket.
+    results = ast.literal_eval(data + ']')
+    print("WARNING: '%s' is incomplete, reading %d results." % (name, len(results)), file=sys.stderr)
+    return results
+
+
+def read_results(f):
+  # Yields result dicts from the open file |f|, in either format.
+  name = getattr(f, 'name', '<results>')
+  first_line = f.readline()
+  if first_line.lstrip().startswith('['):
+    for result in _read_legacy(first_line + f.read(), name):
+      yield result
+    return
+  line = first_line
+  line_number = 1
+  while line:
+    if line.strip():
+      try:
+        yield json.loads(line)
+      except ValueError:
+        if line.endswith('\n'):
+          raise ValueError("%s:%d: invalid result line" % (name, line_number))
+        print("WARNING: Ignoring truncated last line in '%s'." % name, file=sys.stderr)
+    line = f.readline()
+    line_number += 1
@@ -0,0 +1,278 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Job ordering, core budgeting and pipeline stages for generate_data.py.
+
+import json
+import os
+import queue
+import tempfile
+import threading
+import traceback
+
+# Weight of previous runs when updating the cost model with a new measurement.
+HISTORY_WEIGHT = 0.9
+
+
+class CostModel(object):
+  # Seconds per unit of work (pixels * frames) for each encoder preset, learned
+  # from the wall time of previously completed jobs.
+  def __init__(self, model_file=None):
+    self.model_file = model_file
+    self.lock = threading.Lock()
+    self.presets = {}
+    if model_file and os.path.isfile(model_file):
+      try:
+        with open(model_file) as f:
+          self.presets = json.load(f)
+      except ValueError:
+        print("WARNING: Ignoring unreadable cost model '%s'." % model_file)
+
+  def _seconds_per_work(self, preset):
+    with self.lock:
+      if preset in self.presets:
+        entry = self.presets[preset]
+        return entry['seconds'] / entry['work']
+      # Unknown presets are assumed to be as expensive as the average known one.
+      if self.presets:
+        return sum(entry['seconds'] / entry['work'] for entry in self.presets.values()) / len(self.presets)
+      return 1.0
+
+  def estimate(self, preset, work):
+    return self._seconds_per_work(preset) * work
+
+  def update(self, preset, work, seconds):
+    if work <= 0:
+      return
+    with self.lock:
+      entry = self.presets.setdefault(preset, {'seconds': 0.0, 'work': 0.0})
+      entry['seconds'] = entry['seconds'] * HISTORY_WEIGHT + seconds
+      entry['work'] = entry['work'] * HISTORY_WEIGHT + work
+
+  def save(self):
+    if not self.model_file:
+      return
+    model_dir = os.path.dirname(os.path.abspath(self.model_file))
+    if not os.path.isdir(model_dir):
+      os.makedirs(model_dir)
+    with self.lock:
+      (fd, temp_file) = tempfile.mkstemp(dir=model_dir, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self.presets, f, indent=2, sort_keys=True)
+      os.replace(temp_file, self.model_file)
+
+
+class ScratchSpace(object):
+  # Byte budgets of scratch directories, in order of preference (a tmpfs before
+  # a directory on disk, for instance). Only used under the lock of the
+  # JobScheduler it belongs to.
+  # Files shared between jobs, given as (name, size) pairs, are written to the
+  # last directory by the first job that needs them and kept until the run
+  # ends, so they're charged once and never given back.
+  def __init__(self, directories):
+    self.directories = [directory for (directory, _) in directories]
+    self.budgets = [budget for (_, budget) in directories]
+    self.in_use = [0] * len(directories)
+    self.shared = {}
+
+  def _new_shared_bytes(self, shared_files):
+    return sum(dict((name, size) for (name, size) in shared_files if name not in self.shared).values())
+
+  def reserved(self, i):
+    if i == len(self.directories) - 1:
+      return self.in_use[i] + sum(self.shared.values())
+    return self.in_use[i]
+
+  def place(self, size, shared_files=()):
+    # Returns the index of the first directory with room for |size| bytes, as
+    # long as the last one has room for shared files that aren't charged yet, or
+    # None if there's none right now.
+    last = len(self.directories) - 1
+    shared_size = self._new_shared_bytes(shared_files)
+    if self.reserved(last) + shared_size <= self.budgets[last]:
+      for i in range(len(self.directories)):
+        if self.reserved(i) + size + (shared_size if i == last else 0) <= self.budgets[i]:
+          return i
+    # A job larger than every budget runs alone on the last directory rather
+    # than never.
+    if not any(self.in_use):
+      return last
+    return None
+
+  def reserve(self, placement, size, shared_files=()):
+    self.in_use[placement] += size
+    for (name, shared_size) in shared_files:
+      self.shared.setdefault(name, shared_size)
+
+  def release(self, placement, size):
+    self.in_use[placement] -= size
+
+
+class CpuSets(object):
+  # Hands out disjoint sets of CPUs to pin processes to. Callers keep the sum
+  # of CPUs requested within |cpus| (JobScheduler does for encoder threads),
+  # except for single requests larger than that, which get every CPU once
+  # they're all free.
+  def __init__(self, cpus):
+    self.cpus = sorted(cpus)
+    self.free = list(self.cpus)
+    self.cond = threading.Condition()
+
+  def claim(self, count):
+    count = min(count, len(self.cpus))
+    with self.cond:
+      while len(self.free) < count:
+        self.cond.wait()
+      claimed = self.free[:count]
+      del self.free[:count]
+      return claimed
+
+  def release(self, cpus):
+    with self.cond:
+      self.free = sorted(self.free + cpus)
+      self.cond.notify_all()
+
+
+class JobScheduler(object):
+  # Hands out jobs longest first, while keeping the sum of threads used by
+  # running jobs within max_threads, and the sum of their scratch space within
+  # the budgets of |scratch|. Jobs are (cost, threads, scratch bytes, shared
+  # scratch files, item) tuples, see ScratchSpace for shared files. Threads are
+  # released by job_done() once a job's encoder is done, scratch space by
+  # scratch_done() once its files have been removed.
+  # Jobs can be added while running. Holds keep next_job() waiting for them
+  # once pending jobs run out.
+  def __init__(self, jobs, max_threads, scratch=None):
+    self.pending = sorted(jobs, key=lambda job: job[0], reverse=True)
+    self.max_threads = max_threads
+    self.threads_in_use = 0
+    self.scratch = scratch
+    self.holds = 0
+    self.cond = threading.Condition()
+
+  def add(self, job):
+    with self.cond:
+      i = 0
+      while i < len(self.pending) and self.pending[i][0] >= job[0]:
+        i += 1
+      self.pending.insert(i, job)
+      self.cond.notify_all()
+
+  def hold(self):
+    with self.cond:
+      self.holds += 1
+
+  def release(self):
+    with self.cond:
+      self.holds -= 1
+      self.cond.notify_all()
+
+  def _pop_fitting_job(self):
+    for (i, (_, threads, scratch_bytes, shared_files, _)) in enumerate(self.pending):
+      # A job wider than the whole budget runs alone rather than never.
+      if self.threads_in_use + threads <= self.max_threads or self.threads_in_use == 0:
+        placement = self.scratch.place(scratch_bytes, shared_files) if self.scratch else None
+        if self.scratch and placement is None:
+          continue
+        return (self.pending.pop(i), placement)
+    return None
+
+  def next_job(self):
+    # Blocks until a job fits within the thread and scratch budgets. Returns
+    # (job, scratch directory index), or None when all jobs have been handed
+    # out.
+    with self.cond:
+      while self.pending or self.holds:
+        scheduled = self._pop_fitting_job()
+        if scheduled:
+          (job, placement) = scheduled
+          self.threads_in_use += job[1]
+          if placement is not None:
+            self.scratch.reserve(placement, job[2], job[3])
+          return scheduled
+        self.cond.wait()
+      return None
+
+  def job_done(self, job):
+    with self.cond:
+      self.threads_in_use -= job[1]
+      self.cond.notify_all()
+
+  def scratch_done(self, job, placement):
+    with self.cond:
+      if placement is not None:
+        self.scratch.release(placement, job[2])
+      self.cond.notify_all()
+
+  def remaining(self):
+    with self.cond:
+      return len(self.pending)
+
+  def pending_jobs(self):
+    with self.cond:
+      return list(self.pending)
+
+  def scratch_usage(self):
+    # Returns (directory, bytes in use, budget) of each scratch directory.
+    if self.scratch is None:
+      return []
+    with self.cond:
+      return [(directory, self.scratch.reserved(i), budget) for (i, (directory, budget)) in enumerate(zip(self.scratch.directories, self.scratch.budgets))]
+
+
+class Stage(object):
+  # Pool of worker threads calling func on items from a bounded queue. Putting
+  # items blocks while the queue is full, which propagates backpressure to the
+  # stages feeding this one.
+  def __init__(self, func, num_workers, queue_size):
+    self.func = func
+    self.queue = queue.Queue(queue_size)
+    self.busy = 0
+    self.lock = threading.Lock()
+    self.workers = []
+    for i in range(num_workers):
+      t = threading.Thread(target=self._work)
+      t.daemon = True
+      t.start()
+      self.workers.append(t)
+
+  def _work(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      with self.lock:
+        self.busy += 1
+      try:
+        self.func(item)
+      except Exception:
+        traceback.print_exc()
+      finally:
+        with self.lock:
+          self.busy -= 1
+
+  def put(self, item):
+    self.queue.put(item)
+
+  def occupancy(self):
+    # Returns (queued items, items being processed).
+    with self.lock:
+      return (self.queue.qsize(), self.busy)
+
+  def finish(self):
+    # Processes remaining items, then stops all workers.
+    for t in self.workers:
+      self.queue.put(None)
+    for t in self.workers:
+      t.join()
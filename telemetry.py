@@ -0,0 +1,253 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Live progress of generate_data.py runs. Progress is collected into a status
+# dict, which is served in the Prometheus text format over HTTP
+# (--telemetry-port) and periodically written as JSON (--status-file).
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+
+import results_io
+
+METRIC_PREFIX = 'rtc_video_quality_'
+STAGES = ['encode', 'decode', 'metrics', 'vmaf']
+# Upper bounds of stage latency histogram buckets.
+LATENCY_BUCKETS_SECONDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+# Job statuses that ran the job here, as opposed to CACHED or CLAIMED ELSEWHERE.
+RUN_STATUSES = ['OK', 'ERROR']
+
+
+class Histogram(object):
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    i = 0
+    while i < len(self.buckets) and value > self.buckets[i]:
+      i += 1
+    self.counts[i] += 1
+    self.sum += value
+    self.count += 1
+
+  def to_dict(self):
+    # Buckets are cumulative, as in Prometheus.
+    buckets = []
+    total = 0
+    for (bound, count) in zip(self.buckets + ['+Inf'], self.counts):
+      total += count
+      buckets.append([bound, total])
+    return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Telemetry(object):
+  # Counters updated by generate_data.py as jobs start and finish. Everything
+  # else in the status (queued jobs, stage queues, scratch space and cost
+  # estimates) is read from the run's state when a status is requested.
+  def __init__(self):
+    self.start_time = time.monotonic()
+    self.lock = threading.Lock()
+    self.running = {}
+    self.encoding = 0
+    self.done = {}
+    self.latency = dict((stage, Histogram(LATENCY_BUCKETS_SECONDS)) for stage in STAGES)
+    self.frames = 0
+    self.cost_done = 0.0
+
+  def job_started(self, job, encoder, cost):
+    with self.lock:
+      self.running[id(job)] = (encoder, cost)
+
+  def encode_started(self):
+    with self.lock:
+      self.encoding += 1
+
+  def encode_done(self):
+    with self.lock:
+      self.encoding -= 1
+
+  def job_done(self, job, status, results, frames):
+    with self.lock:
+      (encoder, cost) = self.running.pop(id(job))
+      counts = self.done.setdefault(encoder, {})
+      counts[status] = counts.get(status, 0) + 1
+      if status not in RUN_STATUSES:
+        return
+      self.cost_done += cost
+      if not results:
+        return
+      self.frames += frames
+      # Layers share their job's encode, but have a decode and metrics each.
+      for (i, result) in enumerate(results):
+        for stage in STAGES:
+          key = '%s-wall-time-ms' % stage
+          if key in result and (stage != 'encode' or i == 0):
+            self.latency[stage].observe(result[key] / 1000)
+
+  def status(self, queued, stages, scratch, remaining_cost):
+    # |queued| maps encoders to the number of jobs waiting to start, |stages|
+    # maps stages to (queued, busy) and |scratch| lists (directory, reserved
+    # bytes, used bytes, budget bytes). |remaining_cost| is the estimated cost of queued
+    # jobs, in the same unit as the costs of started jobs.
+    with self.lock:
+      elapsed = time.monotonic() - self.start_time
+      jobs = {}
+      for encoder in set(queued) | set(self.done) | set(encoder for (encoder, _) in self.running.values()):
+        jobs[encoder] = {'queued': queued.get(encoder, 0), 'running': 0, 'done': dict(self.done.get(encoder, {}))}
+      for (encoder, _) in self.running.values():
+        jobs[encoder]['running'] += 1
+      stages = dict(stages)
+      stages['encode'] = (sum(queued.values()), self.encoding)
+      # Jobs that have started are assumed to be halfway done on average.
+      remaining = remaining_cost + sum(cost for (_, cost) in self.running.values()) / 2
+      eta = None
+      if self.cost_done > 0:
+        eta = remaining / (self.cost_done / elapsed)
+      return {
+        'elapsed-seconds': elapsed,
+        'jobs': jobs,
+        'stages': dict((stage, {'queued': queued_items, 'busy': busy}) for (stage, (queued_items, busy)) in stages.items()),
+        'latency-seconds': dict((stage, histogram.to_dict()) for (stage, histogram) in self.latency.items()),
+        'frames-processed': self.frames,
+        'frames-per-second': self.frames / elapsed if elapsed > 0 else 0.0,
+        'scratch': [{'directory': directory, 'reserved-bytes': reserved, 'used-bytes': used, 'budget-bytes': budget} for (directory, reserved, used, budget) in scratch],
+        'eta-seconds': eta,
+      }
+
+
+def directory_size(directory):
+  # Bytes of all files below |directory|, skipping files removed while walking
+  # it, since running jobs keep creating and removing them.
+  size = 0
+  for (root, _, files) in os.walk(directory):
+    for name in files:
+      try:
+        size += os.lstat(os.path.join(root, name)).st_size
+      except OSError:
+        pass
+  return size
+
+
+def label_string(labels):
+  def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for (name, value) in labels)
+
+
+def prometheus_text(status):
+  lines = []
+  def metric(name, metric_type, help_text, samples):
+    lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, help_text))
+    lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, metric_type))
+    for (suffix, labels, value) in samples:
+      lines.append('%s%s%s%s %s' % (METRIC_PREFIX, name, suffix, label_string(labels) if labels else '', repr(float(value))))
+
+  job_samples = []
+  for (encoder, jobs) in sorted(status['jobs'].items()):
+    job_samples.append(('', [('encoder', encoder), ('state', 'queued')], jobs['queued']))
+    job_samples.append(('', [('encoder', encoder), ('state', 'running')], jobs['running']))
+    for (job_status, count) in sorted(jobs['done'].items()):
+      job_samples.append(('', [('encoder', encoder), ('state', 'done'), ('status', job_status)], count))
+  metric('jobs', 'gauge', 'Jobs by encoder and state.', job_samples)
+  metric('stage_queued', 'gauge', 'Items waiting for each pipeline stage.', [('', [('stage', stage)], values['queued']) for (stage, values) in sorted(status['stages'].items())])
+  metric('stage_busy', 'gauge', 'Items being processed by each pipeline stage.', [('', [('stage', stage)], values['busy']) for (stage, values) in sorted(status['stages'].items())])
+  latency_samples = []
+  for (stage, histogram) in sorted(status['latency-seconds'].items()):
+    for (bound, count) in histogram['buckets']:
+      latency_samples.append(('_bucket', [('stage', stage), ('le', bound)], count))
+    latency_samples.append(('_sum', [('stage', stage)], histogram['sum']))
+    latency_samples.append(('_count', [('stage', stage)], histogram['count']))
+  metric('stage_latency_seconds', 'histogram', 'Wall time of each stage per job (encode) or layer.', latency_samples)
+  metric('frames_processed_total', 'counter', 'Frames of jobs run to completion.', [('', None, status['frames-processed'])])
+  metric('frames_per_second', 'gauge', 'Frames processed per second since the run started.', [('', None, status['frames-per-second'])])
+  metric('scratch_reserved_bytes', 'gauge', 'Scratch space reserved by running jobs and files shared between jobs.', [('', [('directory', entry['directory'])], entry['reserved-bytes']) for entry in status['scratch']])
+  metric('scratch_used_bytes', 'gauge', 'Scratch space actually used by files in each scratch directory.', [('', [('directory', entry['directory'])], entry['used-bytes']) for entry in status['scratch']])
+  metric('scratch_budget_bytes', 'gauge', 'Scratch space budget.', [('', [('directory', entry['directory'])], entry['budget-bytes']) for entry in status['scratch']])
+  metric('elapsed_seconds', 'gauge', 'Time since the run started.', [('', None, status['elapsed-seconds'])])
+  if status['eta-seconds'] is not None:
+    metric('eta_seconds', 'gauge', 'Estimated time until all queued jobs are done.', [('', None, status['eta-seconds'])])
+  return '\n'.join(lines) + '\n'
+
+
+def serve(port, status_func):
+  # Serves the Prometheus text format on localhost from a daemon thread, until
+  # shutdown() is called on the returned server.
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path != '/metrics':
+        self.send_error(404)
+        return
+      body = prometheus_text(status_func()).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+class StatusFile(object):
+  # Rewrites |filename| with the current status every |interval| seconds, and
+  # once more when stopped.
+  def __init__(self, filename, interval, status_func):
+    self.filename = filename
+    self.interval = interval
+    self.status_func = status_func
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      self.write()
+
+  def write(self):
+    # Failing to write the status doesn't fail the run, later writes may still
+    # succeed.
+    status_dir = os.path.dirname(os.path.abspath(self.filename))
+    temp_file = None
+    try:
+      (fd, temp_file) = tempfile.mkstemp(dir=status_dir, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self.status_func(), f, indent=2, sort_keys=True)
+      results_io.make_readable(temp_file)
+      os.replace(temp_file, self.filename)
+      temp_file = None
+    except Exception as e:
+      print("WARNING: Can't write '%s': %s" % (self.filename, e))
+    finally:
+      if temp_file:
+        os.remove(temp_file)
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.write()
@@ -0,0 +1,106 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reads .y4m headers and locates raw I420 frames inside .y4m files, so that
+# frames can be read in place instead of converting clips to .yuv first.
+#
+# Frame layouts are (data offset, frame stride, number of frames): frame i
+# starts at data offset + i * frame stride. Raw .yuv files have the same layout
+# without headers.
+
+import os
+import threading
+
+SIGNATURE = b'YUV4MPEG2 '
+FRAME_SIGNATURE = b'FRAME'
+# Longest header read, real headers are well below this.
+MAX_HEADER_SIZE = 4096
+
+# Colorspaces stored as 8-bit I420, which only differ in chroma siting. Headers
+# without a colorspace are 420jpeg.
+I420_COLORSPACES = ['420', '420jpeg', '420mpeg2', '420paldv']
+
+layouts = {}
+layouts_lock = threading.Lock()
+
+
+def i420_frame_size(width, height):
+  return width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+
+
+def read_line(f, what):
+  line = f.readline(MAX_HEADER_SIZE)
+  if not line.endswith(b'\n'):
+    raise ValueError("Truncated or oversized %s." % what)
+  return line
+
+
+def read_header(filename):
+  # Returns a dict with width, height, fps and colorspace, and the size of the
+  # stream header.
+  with open(filename, 'rb') as f:
+    line = read_line(f, 'header')
+  if not line.startswith(SIGNATURE):
+    raise ValueError("'%s' is not a .y4m file." % filename)
+  header = {'colorspace': '420jpeg', 'header_size': len(line)}
+  for param in line[len(SIGNATURE):].split():
+    (tag, value) = (chr(param[0]), param[1:].decode('ascii', 'replace'))
+    if tag == 'W':
+      header['width'] = int(value)
+    elif tag == 'H':
+      header['height'] = int(value)
+    elif tag == 'F':
+      (numerator, denominator) = value.split(':')
+      header['fps'] = float(numerator) / float(denominator)
+    elif tag == 'C':
+      header['colorspace'] = value
+  for required in ['width', 'height', 'fps']:
+    if required not in header:
+      raise ValueError("'%s' has no %s in its header." % (filename, required))
+  if header['colorspace'] not in I420_COLORSPACES:
+    raise ValueError("'%s' has unsupported colorspace '%s', only 8-bit 4:2:0 is supported." % (filename, header['colorspace']))
+  return header
+
+
+def index_frames(filename, width, height):
+  header = read_header(filename)
+  frame_size = i420_frame_size(width, height)
+  file_size = os.path.getsize(filename)
+  with open(filename, 'rb') as f:
+    f.seek(header['header_size'])
+    if f.tell() == file_size:
+      return (header['header_size'], frame_size, 0)
+    frame_header = read_line(f, 'frame header')
+    stride = len(frame_header) + frame_size
+    num_frames = (file_size - header['header_size']) // stride
+    # Frame headers are located by the index without parsing them, make sure
+    # they're all where it expects them.
+    for i in range(num_frames):
+      f.seek(header['header_size'] + i * stride)
+      if f.read(len(frame_header)) != frame_header:
+        raise ValueError("'%s' has frame parameters that differ between frames, which aren't supported." % filename)
+  return (header['header_size'] + len(frame_header), stride, num_frames)
+
+
+def frame_layout(filename, width, height):
+  # Layouts of .y4m files are indexed once per file version and cached.
+  if os.path.splitext(filename)[1] != '.y4m':
+    frame_size = i420_frame_size(width, height)
+    return (0, frame_size, os.path.getsize(filename) // frame_size)
+  stat = os.stat(filename)
+  key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns, width, height)
+  with layouts_lock:
+    if key not in layouts:
+      layouts[key] = index_frames(filename, width, height)
+    return layouts[key]
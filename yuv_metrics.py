@@ -0,0 +1,332 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process PSNR/SSIM for I420 files, computing the same values as
+# libvpx/tools/tiny_ssim without a subprocess or intermediate CSV files.
+
+import threading
+
+import numpy as np
+
+import y4m
+
+MAX_PSNR = 100.0
+
+# SSIM constants from tiny_ssim, pre-scaled for 8x8 windows:
+# (64^2 * (.01 * 255)^2 and (64^2 * (.03 * 255)^2.
+SSIM_C1 = 26634
+SSIM_C2 = 239708
+
+# Number of luma pixels processed per batch, bounds memory used by temporaries.
+BATCH_PIXELS = 16 * 1024 * 1024
+
+# Bump when changing scale_plane(), which invalidates downscaled references
+# cached on disk.
+SCALER_VERSION = 1
+
+
+def plane_sizes(width, height):
+  chroma_width = (width + 1) // 2
+  chroma_height = (height + 1) // 2
+  return [(height, width), (chroma_height, chroma_width), (chroma_height, chroma_width)]
+
+
+def frame_size(width, height):
+  return sum(h * w for (h, w) in plane_sizes(width, height))
+
+
+def batch_frames(width, height):
+  return max(1, BATCH_PIXELS // (width * height))
+
+
+def split_planes(frames, width, height):
+  planes = []
+  offset = 0
+  for (h, w) in plane_sizes(width, height):
+    planes.append(frames[:, offset:offset + h * w].reshape(-1, h, w))
+    offset += h * w
+  return planes
+
+
+def open_frames(filename, width, height, offset_frames=0, num_frames=None):
+  # Frames [offset_frames, offset_frames + num_frames) of |filename|, memory
+  # mapped so that clip windows can be used without copying them. Frames of
+  # .y4m files are mapped in place, skipping over frame headers.
+  size = frame_size(width, height)
+  (data_offset, stride, total_frames) = y4m.frame_layout(filename, width, height)
+  available_frames = max(0, total_frames - offset_frames)
+  if num_frames is None or num_frames > available_frames:
+    num_frames = available_frames
+  if num_frames == 0:
+    return np.zeros((0, size), dtype=np.uint8)
+  if stride == size:
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=data_offset + offset_frames * size, shape=(num_frames, size))
+  mapped = np.memmap(filename, dtype=np.uint8, mode='r', offset=data_offset + offset_frames * stride, shape=((num_frames - 1) * stride + size,))
+  return np.lib.stride_tricks.as_strided(mapped, shape=(num_frames, size), strides=(stride, 1), writeable=False)
+
+
+def _area_bins(size, out_size):
+  # First source row/column averaged into each output row/column.
+  return (np.arange(out_size) * size) // out_size
+
+
+def scale_plane(planes, out_height, out_width):
+  # Area-averaging downscale of a batch of planes, each output pixel is the
+  # rounded mean of the source pixels it covers.
+  (b, h, w) = planes.shape
+  rows = _area_bins(h, out_height)
+  cols = _area_bins(w, out_width)
+  sums = np.add.reduceat(np.add.reduceat(planes.astype(np.uint32), rows, axis=1), cols, axis=2)
+  counts = np.diff(np.append(rows, h))[:, None] * np.diff(np.append(cols, w))[None, :]
+  return ((sums + counts // 2) // counts).astype(np.uint8)
+
+
+def write_scaled_frames(reference_file, width, height, offset_frames, num_frames, out_file, out_width, out_height):
+  # Writes frames [offset_frames, offset_frames + num_frames) of |reference_file|
+  # to |out_file|, downscaled to out_width x out_height.
+  frames = open_frames(reference_file, width, height, offset_frames, num_frames)
+  out_planes = plane_sizes(out_width, out_height)
+  step = batch_frames(width, height)
+  with open(out_file, 'wb') as f:
+    for start in range(0, len(frames), step):
+      batch = np.asarray(frames[start:start + step])
+      scaled = [scale_plane(plane, h, w).reshape(len(batch), -1) for (plane, (h, w)) in zip(split_planes(batch, width, height), out_planes)]
+      np.concatenate(scaled, axis=1).tofile(f)
+
+
+def mse2psnr(samples, sse):
+  sse = np.asarray(sse, dtype=np.float64)
+  with np.errstate(divide='ignore'):
+    psnr = 10.0 * np.log10(float(samples) * 255.0 * 255.0 / sse)
+  return np.where(sse > 0, np.minimum(psnr, MAX_PSNR), MAX_PSNR)
+
+
+def plane_sse(reference, distorted):
+  diff = reference.astype(np.int32) - distorted.astype(np.int32)
+  return np.einsum('bij,bij->b', diff, diff, dtype=np.int64)
+
+
+def _sum_4x4(values):
+  (b, h, w) = values.shape
+  return values[:, :h // 4 * 4, :w // 4 * 4].reshape(b, h // 4, 4, w // 4, 4).sum(axis=(2, 4), dtype=np.int64)
+
+
+def _sum_8x8(values):
+  # 8x8 windows sampled at every 4x4 location, built from 4x4 block sums.
+  blocks = _sum_4x4(values)
+  return blocks[:, :-1, :-1] + blocks[:, 1:, :-1] + blocks[:, :-1, 1:] + blocks[:, 1:, 1:]
+
+
+def plane_ssim(reference, distorted):
+  (b, h, w) = reference.shape
+  if h < 8 or w < 8:
+    return np.ones(b)
+  s = reference.astype(np.int32)
+  r = distorted.astype(np.int32)
+  sum_s = _sum_8x8(s)
+  sum_r = _sum_8x8(r)
+  sum_sq_s = _sum_8x8(s * s)
+  sum_sq_r = _sum_8x8(r * r)
+  sum_sxr = _sum_8x8(s * r)
+  count = 64
+  ssim_n = (2 * sum_s * sum_r + SSIM_C1) * (2 * count * sum_sxr - 2 * sum_s * sum_r + SSIM_C2)
+  ssim_d = (sum_s * sum_s + sum_r * sum_r + SSIM_C1) * (count * sum_sq_s - sum_s * sum_s + count * sum_sq_r - sum_r * sum_r + SSIM_C2)
+  return (ssim_n / ssim_d.astype(np.float64)).mean(axis=(1, 2))
+
+
+class FrameMetrics(object):
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    self.samples = [h * w for (h, w) in plane_sizes(width, height)]
+    self.sse = []
+    self.ssim = []
+
+  def add_frames(self, reference, distorted):
+    reference_planes = split_planes(reference, self.width, self.height)
+    distorted_planes = split_planes(distorted, self.width, self.height)
+    self.sse.append(np.stack([plane_sse(s, r) for (s, r) in zip(reference_planes, distorted_planes)], axis=1))
+    self.ssim.append(np.stack([plane_ssim(s, r) for (s, r) in zip(reference_planes, distorted_planes)], axis=1))
+
+  def num_frames(self):
+    return sum(len(sse) for sse in self.sse)
+
+  def results(self):
+    results = {}
+    num_frames = self.num_frames()
+    results['frame-count'] = num_frames
+    if num_frames == 0:
+      return results
+    sse = np.concatenate(self.sse)
+    ssim = np.concatenate(self.ssim)
+    total_samples = sum(self.samples)
+
+    frame_ssim = ssim[:, 0] * 0.8 + 0.1 * (ssim[:, 1] + ssim[:, 2])
+    frame_psnr = mse2psnr(total_samples, sse.sum(axis=1))
+    frame_plane_psnr = [mse2psnr(self.samples[i], sse[:, i]) for i in range(3)]
+
+    results['avg-psnr'] = float(frame_psnr.mean())
+    results['glb-psnr'] = float(mse2psnr(num_frames * total_samples, sse.sum()))
+    for (i, plane) in enumerate(['y', 'u', 'v']):
+      results['avg-psnr-%s' % plane] = float(frame_plane_psnr[i].mean())
+      results['glb-psnr-%s' % plane] = float(mse2psnr(num_frames * self.samples[i], sse[:, i].sum()))
+      results['ssim-%s' % plane] = float(ssim[:, i].mean())
+      results['frame-ssim-%s' % plane] = ssim[:, i].tolist()
+      results['frame-psnr-%s' % plane] = frame_plane_psnr[i].tolist()
+    results['ssim'] = float(frame_ssim.mean())
+    results['vpx-ssim'] = 100.0 * results['ssim'] ** 8
+    results['frame-ssim'] = frame_ssim.tolist()
+    results['frame-psnr'] = frame_psnr.tolist()
+    return results
+
+
+def temporal_activity(filename, width, height, offset_frames=0, num_frames=None, subsample=4):
+  # Mean absolute luma difference to the previous frame for each frame (0 for
+  # the first), on a subsampled grid. Used to find scene cuts and pick
+  # representative parts of clips.
+  frames = open_frames(filename, width, height, offset_frames, num_frames)
+  activity = np.zeros(len(frames))
+  step = batch_frames(width, height)
+  previous = None
+  for start in range(0, len(frames), step):
+    luma = split_planes(np.asarray(frames[start:start + step]), width, height)[0][:, ::subsample, ::subsample].astype(np.int16)
+    first = start + 1
+    if previous is not None:
+      luma = np.concatenate([previous, luma])
+      first = start
+    activity[first:first + len(luma) - 1] = np.mean(np.abs(np.diff(luma, axis=0)), axis=(1, 2))
+    previous = luma[-1:]
+  return activity
+
+
+def compute_metrics(reference_file, distorted_file, width, height, temporal_skip=0, reference_offset=0, reference_frames=None):
+  return compute_layer_metrics(reference_file, [(distorted_file, temporal_skip)], width, height, reference_offset, reference_frames)[0]
+
+
+def compute_layer_metrics(reference_file, layers, width, height, reference_offset=0, reference_frames=None):
+  # Metrics for several decoded layers of the same clip window, as
+  # (distorted_file, temporal_skip) pairs. Every (temporal_skip + 1)th reference
+  # frame is compared against consecutive decoded frames, same as tiny_ssim.
+  # The reference is read once, each batch of it is compared against the frames
+  # of all layers that contain them.
+  reference = open_frames(reference_file, width, height, reference_offset, reference_frames)
+  distorted = [open_frames(distorted_file, width, height) for (distorted_file, _) in layers]
+  metrics = [FrameMetrics(width, height) for layer in layers]
+  divides = [temporal_skip + 1 for (_, temporal_skip) in layers]
+  num_frames = min(len(reference), max([len(frames) * divide for (frames, divide) in zip(distorted, divides)] + [0]))
+  step = batch_frames(width, height)
+  for start in range(0, num_frames, step):
+    batch = np.asarray(reference[start:min(start + step, num_frames)])
+    for (frames, divide, layer_metrics) in zip(distorted, divides, metrics):
+      # Layer frames whose reference frames are within this batch.
+      first = -(-start // divide)
+      last = min(-(-(start + len(batch)) // divide), len(frames))
+      if last > first:
+        layer_metrics.add_frames(batch[first * divide - start::divide][:last - first], frames[first:last])
+  return [layer_metrics.results() for layer_metrics in metrics]
+
+
+class FrameRing(object):
+  # Fixed-size ring of frame slots, filled from a stream (e.g. a decoder pipe)
+  # by a reader thread and drained in contiguous batches by the consumer.
+  def __init__(self, stream, size, num_slots):
+    self.stream = stream
+    self.size = size
+    self.buffer = np.empty((num_slots, size), dtype=np.uint8)
+    self.num_slots = num_slots
+    self.read_index = 0
+    self.write_index = 0
+    self.eof = False
+    self.closed = False
+    self.error = None
+    self.cond = threading.Condition()
+    self.reader = threading.Thread(target=self._fill)
+    self.reader.daemon = True
+    self.reader.start()
+
+  def _read_frame(self, slot):
+    view = memoryview(self.buffer[slot])
+    read = 0
+    while read < self.size:
+      n = self.stream.readinto(view[read:])
+      if not n:
+        if read:
+          raise ValueError('Stream ended %d bytes into a frame of %d bytes.' % (read, self.size))
+        return False
+      read += n
+    return True
+
+  def _fill(self):
+    try:
+      while True:
+        with self.cond:
+          while self.write_index - self.read_index == self.num_slots and not self.closed:
+            self.cond.wait()
+          if self.closed:
+            break
+        if not self._read_frame(self.write_index % self.num_slots):
+          break
+        with self.cond:
+          self.write_index += 1
+          self.cond.notify_all()
+    except Exception as e:
+      self.error = e
+    with self.cond:
+      self.eof = True
+      self.cond.notify_all()
+
+  def batches(self, max_frames):
+    while True:
+      with self.cond:
+        while self.write_index == self.read_index and not self.eof:
+          self.cond.wait()
+        if self.error is not None:
+          raise self.error
+        available = self.write_index - self.read_index
+        if available == 0:
+          return
+        start = self.read_index % self.num_slots
+        count = min(available, self.num_slots - start, max_frames)
+      yield self.buffer[start:start + count]
+      with self.cond:
+        self.read_index += count
+        self.cond.notify_all()
+
+  def close(self):
+    # Stops the reader thread once it's done with the frame being read, if the
+    # consumer stops early.
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+
+def stream_metrics(reference_file, stream, width, height, temporal_skip=0, reference_offset=0, reference_frames=None, sinks=()):
+  # Same as compute_metrics(), but decoded frames are consumed from |stream| as
+  # they arrive instead of from a file. Frames are additionally written to each
+  # file object in |sinks|.
+  reference = open_frames(reference_file, width, height, reference_offset, reference_frames)[::temporal_skip + 1]
+  metrics = FrameMetrics(width, height)
+  step = batch_frames(width, height)
+  ring = FrameRing(stream, frame_size(width, height), 2 * step)
+  try:
+    for distorted in ring.batches(step):
+      for sink in sinks:
+        sink.write(distorted.data)
+      start = metrics.num_frames()
+      end = min(start + len(distorted), len(reference))
+      if end > start:
+        metrics.add_frames(reference[start:end], distorted[:end - start])
+  finally:
+    ring.close()
+  return metrics.results()